@@ -0,0 +1,79 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import cache
+
+# How many master commits to remember results for.  Everything is keyed by the
+# master commit it was computed against, so entries for older masters are
+# never looked at again once master moves on.
+MAX_MASTERS = 20
+
+
+def fingerprint(diff: str) -> str:
+    # Two approvals are interchangeable when the PR makes exactly the same
+    # change to master at both commits, so the fingerprint is a hash of the
+    # whole diff.
+    return hashlib.sha256(diff.encode('utf-8')).hexdigest()
+
+
+# Persistent record, across runs, of what we've learned about old approvals:
+#
+#   (master sha, commit sha) -> fingerprint of the PR's diff against master if
+#                               merged at that commit, or '' if it can't merge
+#
+#   (master sha, approved commit, target commit) -> whether an approval at the
+#                                                   first still counts at the
+#                                                   second
+#
+# When master moves, the key changes and we recompute.
+class ApprovalIndex:
+    def __init__(self, repo: str):
+        self._path = os.path.join(cache.cache_dir('approvals'), '%s.json' % repo.replace('/', '-'))
+        self._lock = threading.Lock()
+        self._data: Dict[str, Any] = cache.read_json(self._path, default={})
+
+    def _master_entry(self, master: str) -> Dict[str, Any]:
+        entry = self._data.setdefault(master, {'fingerprints': {}, 'decisions': {}})
+        entry['used'] = int(time.time())
+        return entry
+
+    def fingerprint(self, master: str, commit: str) -> Optional[str]:
+        with self._lock:
+            return self._data.get(master, {}).get('fingerprints', {}).get(commit)
+
+    def set_fingerprint(self, master: str, commit: str, value: str) -> None:
+        with self._lock:
+            self._master_entry(master)['fingerprints'][commit] = value
+            self._save()
+
+    def decision(self, master: str, approved_commit: str, target_commit: str) -> Optional[bool]:
+        with self._lock:
+            return self._data.get(master, {}).get('decisions', {}).get(
+                '%s %s' % (approved_commit, target_commit))
+
+    def set_decision(self, master: str, approved_commit: str, target_commit: str,
+                     still_valid: bool) -> None:
+        with self._lock:
+            self._master_entry(master)['decisions'][
+                '%s %s' % (approved_commit, target_commit)] = still_valid
+            self._save()
+
+    def _save(self) -> None:
+        recent = sorted(self._data, key=lambda master: self._data[master].get('used', 0))
+        for master in recent[:-MAX_MASTERS]:
+            del self._data[master]
+        cache.write_json(self._path, self._data)
+
+
+_indexes: Dict[str, ApprovalIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def for_repo(repo: str) -> ApprovalIndex:
+    with _indexes_lock:
+        if repo not in _indexes:
+            _indexes[repo] = ApprovalIndex(repo)
+        return _indexes[repo]
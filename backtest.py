@@ -0,0 +1,367 @@
+import argparse
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Tuple
+
+import cache
+import capture
+import game_state
+import git_mirror
+import git_repo
+import points
+import pull_request
+import util
+import validate
+
+# Would a rule change have blocked anything that's already been merged?  This
+# walks master's first-parent history back to the restart, and for every
+# merged PR rebuilds what validate.py saw when it was checked: the merge
+# result checked out, the PR's details, diff and reviews, and the game state
+# as of the master it was merged into.  Each PR is then evaluated by two rule
+# sets, master's rules (--base) and the rules in your checkout (--rules), and
+# any PR where the verdict or the deciding rule differs is reported.
+#
+# PRs are evaluated several at a time (--jobs), each in its own process with
+# its own worktree from the mirror, since rules look at the current directory.
+#
+# Nothing is fetched unless you pass --fetch: the history comes from the
+# mirror, and PR details and reviews from the HTTP cache.  Where a PR isn't
+# cached, its details are worked out from git, and it's treated as having no
+# reviews except its author's; the report counts how many PRs that was.  Both
+# rule sets see the same inputs either way, so that only matters for which
+# verdicts there are to compare.
+
+# Unlike points.MERGE_REGEXP, we also need the PR number and branch.
+PR_MERGE_REGEXP = '^Merge pull request #(\\d+) from ([^/]*)/(\\S*)'
+
+
+class MergedPR:
+    # One merge to master, and everything about the game as of just before
+    # it that doesn't need a checkout.
+    def __init__(self, number: str, author: str, branch: str, merge: git_repo.Commit,
+                 user_points: Dict[str, Dict[str, int]], master_ts: int, head_ts: int):
+        self.number = number
+        self.author = author
+        self.branch = branch
+        self.merge_sha = merge.sha
+        self.merged_ts = merge.committer_ts
+        self.master_sha, self.head_sha = merge.parents
+        self.master_ts = master_ts
+        self.head_ts = head_ts
+        self.user_points = user_points
+
+
+def merged_prs(repository: git_repo.Repository, head: str) -> List[MergedPR]:
+    # Oldest first.  Points are bonuses from the merge result, which is what
+    # was checked out when the PR was validated, and merges as of master.
+    commits: List[git_repo.Commit] = []
+    sha: Optional[str] = repository.resolve(head)
+    while sha and sha != points.RESTART_COMMIT:
+        try:
+            commit = repository.commit(sha)
+        except git_repo.MissingObject:
+            if not commits:
+                raise
+            break  # A shallow clone's history stops early.
+        commits.append(commit)
+        sha = commit.parents[0] if commit.parents else None
+
+    prs = []
+    merges: Dict[str, int] = {}
+    for commit in reversed(commits):
+        match = re.match(PR_MERGE_REGEXP, commit.subject)
+        if match and len(commit.parents) == 2:
+            number, author, branch = match.groups()
+            prs.append(MergedPR(number, author, branch, commit,
+                                points._standings(points.bonuses_at(commit.sha, repository), merges),
+                                repository.commit(commit.parents[0]).committer_ts,
+                                repository.commit(commit.parents[1]).committer_ts))
+
+        commit_username = points.merge_author(commit.subject)
+        if commit_username:
+            merges[commit_username] = merges.get(commit_username, 0) + 1
+    return prs
+
+
+def _ts_to_iso8601(ts: int) -> str:
+    # The inverse of util.iso8601_to_ts, which reads times as local.
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.localtime(ts))
+
+
+class HistoricalPullRequest(pull_request.PullRequest):
+    # A merged PR as it was when it was merged.  Its diff is what the merge
+    # changed on master, ages are counted up to the merge rather than now, and
+    # old approvals are compared using the mirror alone.
+    def __init__(self, repo: str, merged: MergedPR, users: List[str]):
+        mirror = git_mirror.mirror(repo)
+        self._merged = merged
+        self.details_known = True
+        self.reviews_known = True
+
+        try:
+            pr_json = util.request('%s/%s' % (pull_request.pulls_url(repo), merged.number)).json()
+        except Exception:
+            self.details_known = False
+            pr_json = self._details_from_git(mirror, merged)
+
+        pull_request.share_diff((repo, merged.number, merged.head_sha),
+                                mirror.diff(merged.master_sha, merged.merge_sha))
+        super().__init__(repo=repo, pr_number=merged.number, target_commit=merged.head_sha,
+                         users=users, pr_json=pr_json, prefetch_reviews=False)
+
+        try:
+            self._raw_reviews = self._fetch_reviews(util.request(self._reviews_url()))
+        except Exception:
+            self.reviews_known = False
+            self._raw_reviews = []
+
+    @staticmethod
+    def _details_from_git(mirror: git_mirror.Mirror, merged: MergedPR) -> Dict[str, Any]:
+        # The parts of the API's PR that rules use.  It was opened no later
+        # than its first commit was made.
+        base = mirror.git_output('merge-base', merged.master_sha, merged.head_sha).strip()
+        commit_times = mirror.git_output('log', '--format=%ct', '%s..%s' % (base, merged.head_sha)).split()
+        return {
+            'number': int(merged.number),
+            'user': {'login': merged.author},
+            'created_at': _ts_to_iso8601(int(commit_times[-1]) if commit_times else merged.head_ts),
+            'head': {
+                'sha': merged.head_sha,
+                'ref': merged.branch,
+                'repo': {'clone_url': mirror.url, 'pushed_at': _ts_to_iso8601(merged.head_ts)},
+            },
+        }
+
+    def pushed_at_ts(self) -> int:
+        # The API's pushed_at is the fork's latest push, which can be long
+        # after the merge.  Then the best we know is when the commit that was
+        # merged was made.
+        pushed_at = super().pushed_at_ts()
+        if pushed_at > self._merged.merged_ts:
+            return self._merged.head_ts
+        return pushed_at
+
+    def days_since_created(self) -> int:
+        return util.seconds_to_days(self._merged.merged_ts - self.created_at_ts())
+
+    def days_since_pushed(self) -> int:
+        return util.seconds_to_days(self._merged.merged_ts - self.pushed_at_ts())
+
+    def days_since_changed(self) -> int:
+        return util.seconds_to_days(self._merged.merged_ts - self.last_changed_ts())
+
+    def _pr_diff_identical(self, commit_a: str, commit_b: str) -> bool:
+        # Whether an approval at an old commit counted, against the master
+        # the PR was merged into.  The approval index is keyed by today's
+        # master, so it's no help here.
+        mirror = git_mirror.mirror(self._repo)
+        master = self._merged.master_sha
+        try:
+            return (mirror.diff(master, mirror.merge_tree(master, commit_a)) ==
+                    mirror.diff(master, mirror.merge_tree(master, commit_b)))
+        except Exception:
+            return False
+
+
+def materialize_rules(rules: Dict[str, bytes], skip: List[str]) -> str:
+    # Write a rule set out to its own directory, so both sets can be loaded
+    # side by side from outside the worktrees.
+    rules_dir = tempfile.mkdtemp(prefix='backtest-rules-')
+    for rule_fname, source in rules.items():
+        if rule_fname.endswith('.py') and not any(rule_fname.startswith(prefix + '-') for prefix in skip):
+            with open(os.path.join(rules_dir, rule_fname), 'wb') as outf:
+                outf.write(source)
+    return rules_dir
+
+
+def rules_at(repository: git_repo.Repository, rev: str) -> Dict[str, bytes]:
+    for entry in repository.tree(rev):
+        if entry.name == 'rules' and entry.is_tree():
+            return {rule.name: repository.blob(rule.sha) for rule in repository.tree(entry.sha)
+                    if not rule.is_tree()}
+    raise Exception('No rules/ at %s' % rev)
+
+
+def rules_in(rules_dir: str) -> Dict[str, bytes]:
+    rules = {}
+    for rule_fname in os.listdir(rules_dir):
+        path = os.path.join(rules_dir, rule_fname)
+        if os.path.isfile(path):
+            with open(path, 'rb') as inf:
+                rules[rule_fname] = inf.read()
+    return rules
+
+
+# Set in each worker process by _init_worker.
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(slots: Any, repo: str, rule_sets: List[Tuple[str, str]], fetch: bool) -> None:
+    _worker['worktree'] = slots.get()
+    _worker['repo'] = repo
+    _worker['rule_sets'] = rule_sets
+    util.set_offline(not fetch)
+    # Hundreds of old masters would push out the verdicts worth keeping.
+    os.environ['NOMIC_NO_VERDICT_CACHE'] = '1'
+
+
+def _evaluate(pr: pull_request.PullRequest, state: game_state.GameState, rules_dir: str) -> Dict[str, Any]:
+    result: Dict[str, Any] = {}
+    with capture.captured_output() as output:
+        try:
+            verdict = validate.evaluate_rules(pr, state, rules_dir)
+            result['allowed'] = verdict.allowed
+            result['rule'] = os.path.basename(verdict.rule) if verdict.rule else None
+            result['reason'] = verdict.reason
+            result['error'] = None
+        except Exception as e:
+            traceback.print_exc()
+            result['allowed'] = False
+            result['rule'] = None
+            result['reason'] = None
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['output'] = output.getvalue()
+    return result
+
+
+def replay_merge(merged: MergedPR) -> Dict[str, Any]:
+    report: Dict[str, Any] = {
+        'pr': merged.number,
+        'author': merged.author,
+        'merge': merged.merge_sha,
+        'target_commit': merged.head_sha,
+        'details_known': None,
+        'reviews_known': None,
+        'error': None,
+    }
+    mirror = git_mirror.mirror(_worker['repo'])
+    original_cwd = os.getcwd()
+    try:
+        with mirror.checkout(_worker['worktree'], merged.merge_sha) as checkout:
+            os.chdir(checkout)
+            try:
+                users = util.users()
+                state = game_state.build(users, merged.user_points, merged.master_sha, merged.master_ts,
+                                         now=merged.merged_ts)
+                # Working out which old approvals count prints about them.
+                with capture.captured_output():
+                    pr = HistoricalPullRequest(_worker['repo'], merged, users)
+                    report['approvals'] = sorted(pr.approvals)
+                report['details_known'] = pr.details_known
+                report['reviews_known'] = pr.reviews_known
+                for name, rules_dir in _worker['rule_sets']:
+                    report[name] = _evaluate(pr, state, rules_dir)
+            finally:
+                os.chdir(original_cwd)
+                pull_request.forget_shared_diffs(set())
+    except Exception as e:
+        report['error'] = '%s: %s' % (type(e).__name__, e)
+    return report
+
+
+def _describe(result: Dict[str, Any]) -> str:
+    if result['error']:
+        return 'error (%s)' % result['error']
+    return '%s by %s' % ('allowed' if result['allowed'] else 'blocked', result['rule'] or 'default')
+
+
+def changed(report: Dict[str, Any]) -> bool:
+    if report['error']:
+        return False
+    base, proposed = report['base'], report['proposed']
+    return (base['allowed'], base['rule'], base['error']) != (proposed['allowed'], proposed['rule'],
+                                                              proposed['error'])
+
+
+def start():
+    parser = argparse.ArgumentParser(
+        description='Evaluate every merged PR with master\'s rules and with yours, and report where they differ.')
+    parser.add_argument('--repo', default=os.environ.get('TRAVIS_REPO_SLUG', 'jeffkaufman/nomic'))
+    parser.add_argument('--base', default='master',
+                        help='revision whose rules to compare against (default master)')
+    parser.add_argument('--rules', default='rules',
+                        help='directory of the rules to try (default: rules/ here)')
+    parser.add_argument('--skip', action='append', default=[], metavar='PREFIX',
+                        help='leave out rules starting PREFIX-, like 0.15 (repeatable)')
+    parser.add_argument('--limit', type=int, default=None, help='only the most recent LIMIT merges')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='how many PRs to evaluate at once (default: one per CPU)')
+    parser.add_argument('--fetch', action='store_true',
+                        help='update the mirror and fetch PRs and reviews that aren\'t cached')
+    parser.add_argument('--json', default=None, metavar='FILE', help='write every report to FILE')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    util.set_offline(not args.fetch)
+    mirror = git_mirror.mirror(args.repo)
+    if args.fetch:
+        mirror.update()
+    repository = git_repo.repository(mirror.path)
+
+    prs = merged_prs(repository, 'refs/heads/master')
+    if args.limit is not None:
+        prs = prs[-args.limit:] if args.limit else []
+    if not prs:
+        print('No merged PRs to replay.')
+        return
+
+    rule_sets = [('base', materialize_rules(rules_at(repository, args.base), args.skip)),
+                 ('proposed', materialize_rules(rules_in(args.rules), args.skip))]
+    jobs = max(1, min(args.jobs, len(prs)))
+
+    # Worktrees are made here, one at a time, so workers only ever move them.
+    context = multiprocessing.get_context('spawn')
+    slots = context.Queue()
+    for slot in range(jobs):
+        worktree = 'backtest-%s-%s' % (args.repo.replace('/', '-'), slot)
+        with mirror.checkout(worktree, prs[0].merge_sha):
+            pass
+        slots.put(worktree)
+
+    print('Replaying %s merged PRs with %s workers' % (len(prs), jobs))
+    sys.stdout.flush()
+    reports = []
+    try:
+        pool = context.Pool(jobs, _init_worker, (slots, args.repo, rule_sets, args.fetch))
+        try:
+            for report in pool.imap(replay_merge, prs):
+                reports.append(report)
+                if report['error']:
+                    print('PR %s: failed to replay: %s' % (report['pr'], report['error']))
+                elif changed(report):
+                    print('PR %s (%s, merged as %s): %s, now %s' % (
+                        report['pr'], report['author'], report['merge'][:8],
+                        _describe(report['base']), _describe(report['proposed'])))
+                sys.stdout.flush()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        for _, rules_dir in rule_sets:
+            shutil.rmtree(rules_dir, ignore_errors=True)
+
+    if args.json:
+        cache.write_json(args.json, reports)
+
+    n_changed = sum(1 for report in reports if changed(report))
+    n_errors = sum(1 for report in reports if report['error'])
+    print('\n%s of %s merged PRs would get a different verdict (%s failed to replay) in %.1fs' % (
+        n_changed, len(reports), n_errors, time.time() - start_time))
+    n_details = sum(1 for report in reports if report['details_known'] is False)
+    n_reviews = sum(1 for report in reports if report['reviews_known'] is False)
+    if n_details or n_reviews:
+        print('Details of %s PRs and reviews of %s weren\'t available%s' % (
+            n_details, n_reviews, '' if args.fetch else ' offline; --fetch to get them'))
+
+    if n_changed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    start()
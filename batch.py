@@ -0,0 +1,143 @@
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import cache
+import capture
+import game_state
+import pull_request
+import ratelimit
+import rule_loader
+import tracing
+import util
+import validate
+
+DEFAULT_REPO = 'jeffkaufman/nomic'
+DEFAULT_JOBS = 4
+
+
+def open_reviewme_prs(repo: str) -> List[Tuple[str, str]]:
+    # Returns (pr number, head sha) for every open PR labeled "reviewme".
+    prs = []
+    url: Optional[str] = '%s?state=open&per_page=100' % pull_request.pulls_url(repo)
+    while url:
+        response = util.request(url)
+        for pr_json in response.json():
+            if 'reviewme' in [label['name'] for label in pr_json.get('labels', [])]:
+                prs.append((str(pr_json['number']), pr_json['head']['sha']))
+        url = response.links.get('next', {}).get('url')
+    return prs
+
+
+def head_commits(repo: str, pr_numbers: List[str]) -> List[Tuple[str, str]]:
+    responses = util.request_all(['%s/%s' % (pull_request.pulls_url(repo), pr_number)
+                                  for pr_number in pr_numbers])
+    return [(pr_number, response.json()['head']['sha'])
+            for pr_number, response in zip(pr_numbers, responses)]
+
+
+def evaluate(repo: str, pr_number: str, target_commit: str, state: game_state.GameState,
+             pr: Optional[pull_request.PullRequest] = None) -> Dict[str, Any]:
+    # pr is the PR already loaded, if it has been.
+    report: Dict[str, Any] = {
+        'repo': repo,
+        'pr': pr_number,
+        'target_commit': target_commit,
+        'evaluated_at': int(time.time()),
+    }
+
+    with capture.captured_output() as output:
+        try:
+            if pr is None:
+                pr = pull_request.PullRequest(repo=repo,
+                                              pr_number=pr_number,
+                                              target_commit=target_commit,
+                                              users=list(state.users))
+            verdict = validate.evaluate_rules(pr, state)
+
+            report['author'] = pr.author()
+            report['approvals'] = sorted(pr.approvals)
+            report['rejections'] = sorted(pr.rejections)
+            report['non_participants'] = sorted(pr.non_participants)
+            report['allowed'] = verdict.allowed
+            report['rule'] = verdict.rule
+            report['reason'] = verdict.reason
+            report['error'] = None
+        except Exception as e:
+            # We couldn't get as far as a verdict, which is different from a
+            # rule blocking.
+            traceback.print_exc()
+            report['allowed'] = False
+            report['rule'] = None
+            report['reason'] = None
+            report['error'] = '%s: %s' % (type(e).__name__, e)
+
+    report['output'] = output.getvalue()
+    return report
+
+
+def start():
+    parser = argparse.ArgumentParser(
+        description='Check whether each of several PRs can merge, writing a JSON report per PR.')
+    parser.add_argument('prs', nargs='*', help='PR numbers to check')
+    parser.add_argument('--all', action='store_true',
+                        help='check every open PR labeled "reviewme"')
+    parser.add_argument('--repo', default=os.environ.get('TRAVIS_REPO_SLUG', DEFAULT_REPO))
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                        help='how many PRs to check at once (default %s)' % DEFAULT_JOBS)
+    parser.add_argument('--priority', choices=sorted(ratelimit.PRIORITIES), default='dashboard',
+                        help='how to share the API budget with other runs (default dashboard)')
+    parser.add_argument('--output-dir', default=None,
+                        help='where to write reports (default: the "reports" cache directory)')
+    args = parser.parse_args()
+
+    if args.all == bool(args.prs):
+        parser.error('pass either PR numbers or --all')
+
+    # Refreshing reports can wait; validating PRs for merging can't.
+    ratelimit.set_priority(ratelimit.PRIORITIES[args.priority])
+
+    output_dir = args.output_dir or cache.cache_dir('reports')
+    os.makedirs(output_dir, exist_ok=True)
+
+    try:
+        prs = open_reviewme_prs(args.repo) if args.all else head_commits(args.repo, args.prs)
+        ratelimit.check(len(prs) * validate.ESTIMATED_REQUESTS)
+
+        # Everything that doesn't depend on the PR is worked out once up front,
+        # and then shared by every PR: the GameState (players, points as of
+        # master, when master last changed) and the compiled rules.
+        state = game_state.snapshot()
+        for _, rule_full_fname, _, _ in validate.list_rules():
+            rule_loader.compiled_rule(rule_full_fname)
+
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            reports = list(executor.map(
+                lambda pr: evaluate(args.repo, pr[0], pr[1], state), prs))
+
+        print('%-6s %-8s %-40s %s' % ('PR', 'verdict', 'rule', 'approvals'))
+        for report in reports:
+            cache.write_json(os.path.join(output_dir, '%s.json' % report['pr']), report)
+
+            if report['error']:
+                verdict = 'error'
+            else:
+                verdict = 'allowed' if report['allowed'] else 'blocked'
+            print('%-6s %-8s %-40s %s' % (
+                report['pr'], verdict, report['rule'] or report['error'] or '',
+                ' '.join(report.get('approvals', []))))
+        print('\nReports written to %s' % output_dir)
+    finally:
+        cache.print_stats()
+        tracing.report()
+
+    if any(report['error'] for report in reports):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    start()
@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import capture
+import pull_request
+import synthetic
+import util
+import validate
+
+# Times the expensive parts of validate.py against synthetic repositories of
+# growing size, entirely offline (see synthetic.py and replay.py).  Each size
+# is varied on its own, starting from synthetic.DEFAULT_CONFIG.
+#
+# Each measurement runs in a fresh process in the synthetic checkout: "cold"
+# with an empty cache directory, and "warm" with the one the cold run left
+# behind.
+
+OPERATIONS = ['points', 'pull_request', 'mergeable', 'winner']
+
+DEFAULT_SIZES = {
+    'players': '5,50',
+    'merges': '100,1000,10000',
+    'review_pages': '1,10',
+    'stale_approvals': '0,4',
+}
+
+# Checking for a winner runs after every merge, and should start quickly.  It
+# must never import these, which only checking PRs needs.
+STARTUP_FORBIDDEN_MODULES = ['requests', 'unidiff', 'pycodestyle', 'http.server']
+
+# Well above what importing validate.py takes today, so this only fails on a
+# real regression, like something heavy being imported at the top level again.
+DEFAULT_STARTUP_BUDGET = 0.1
+
+# Run in a fresh interpreter in the synthetic checkout.
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import validate
+imported = time.perf_counter()
+try:
+    validate.determine_if_winner()
+except Exception:
+    pass  # Someone won, which is fine.
+finished = time.perf_counter()
+print(json.dumps({'import': imported - start, 'winner': finished - imported, 'modules': sorted(sys.modules)}))
+"""
+
+# Also run in the synthetic checkout.  Whatever one rule does through the
+# public accessors of its view of the PR, the next rule's view should look the
+# same as the first one's did, and the diff should still only be parsed once.
+VIEWS_SCRIPT = """
+import json, os, unidiff
+parses = []
+parse = unidiff.PatchSet.__init__
+unidiff.PatchSet.__init__ = lambda self, *args: parses.append(1) or parse(self, *args)
+import pull_request, util
+pr = pull_request.PullRequest(repo=os.environ['TRAVIS_REPO_SLUG'],
+                              pr_number=os.environ['TRAVIS_PULL_REQUEST'],
+                              target_commit=os.environ['TRAVIS_PULL_REQUEST_SHA'],
+                              users=util.users())
+
+def looks(view):
+    return [str(view.diff()), view.diff_summary().added, view.approvals, view.rejections,
+            view.non_participants, sorted(view.reviews.items())]
+
+before = looks(pull_request.PullRequestView(pr))
+changed = pull_request.PullRequestView(pr)
+for hunk in [hunk for patched_file in changed.diff() for hunk in patched_file]:
+    hunk.clear()
+changed.diff().clear()
+changed.diff_summary().added.clear()
+changed.approvals.clear()
+changed.non_participants.append('someone-else')
+changed.reviews.clear()
+after = looks(pull_request.PullRequestView(pull_request.PullRequestView(pr)))
+print(json.dumps({'isolated': before == after, 'parses': len(parses)}))
+"""
+
+
+def operation(name: str) -> Callable[[], Any]:
+    def new_pr() -> pull_request.PullRequest:
+        return pull_request.PullRequest(repo=os.environ['TRAVIS_REPO_SLUG'],
+                                        pr_number=os.environ['TRAVIS_PULL_REQUEST'],
+                                        target_commit=os.environ['TRAVIS_PULL_REQUEST_SHA'],
+                                        users=util.users())
+
+    if name == 'points':
+        return util.get_user_points
+    if name == 'pull_request':
+        # Reviews are worked out lazily, so ask for them.
+        return lambda: new_pr().reviews
+    if name == 'mergeable':
+        # Loading the PR isn't part of this one.
+        pr = new_pr()
+        return lambda: validate.determine_if_mergeable(pr)
+    if name == 'winner':
+        return validate.determine_if_winner
+    raise Exception('Unknown operation %s' % name)
+
+
+def measure(name: str) -> None:
+    # Runs in the synthetic checkout, and reports back on the last line of
+    # stdout.
+    with capture.captured_output():
+        fn = operation(name)
+        start = time.perf_counter()
+        try:
+            fn()
+            outcome = 'ok'
+        except Exception as e:
+            # Blocking and winning are both exceptions, and are still results.
+            outcome = str(e)
+        seconds = time.perf_counter() - start
+
+    print(json.dumps({'seconds': seconds, 'outcome': outcome}))
+
+
+def run_measurement(built: synthetic.Synthetic, name: str, cache_dir: str) -> Dict[str, Any]:
+    env = dict(os.environ)
+    env.update(synthetic.environment(built))
+    env['NOMIC_CACHE_DIR'] = cache_dir
+    completed_process = subprocess.run(
+        [sys.executable, os.path.join(built.repo_dir, 'benchmark.py'), '--measure', name],
+        cwd=built.repo_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if completed_process.returncode != 0:
+        raise Exception('%s failed:\n%s' % (name, completed_process.stderr.decode('utf-8')))
+    return json.loads(completed_process.stdout.decode('utf-8').strip().split('\n')[-1])
+
+
+def measure_startup(built: synthetic.Synthetic, cache_dir: str) -> Dict[str, Any]:
+    env = dict(os.environ)
+    env.update(synthetic.environment(built))
+    env['NOMIC_CACHE_DIR'] = cache_dir
+    env['TRAVIS_PULL_REQUEST'] = 'false'
+    start = time.perf_counter()
+    completed_process = subprocess.run(
+        [sys.executable, '-c', STARTUP_SCRIPT],
+        cwd=built.repo_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    wall = time.perf_counter() - start
+    if completed_process.returncode != 0:
+        raise Exception('startup check failed:\n%s' % completed_process.stderr.decode('utf-8'))
+    result = json.loads(completed_process.stdout.decode('utf-8').strip().split('\n')[-1])
+    result['wall'] = wall
+    return result
+
+
+def check_startup(budget: float, repeat: int) -> bool:
+    # Returns whether checking for a winner starts within budget without
+    # importing anything it shouldn't.
+    with tempfile.TemporaryDirectory(prefix='nomic-benchmark-') as tmp:
+        built = synthetic.generate(synthetic.DEFAULT_CONFIG, os.path.join(tmp, 'build'))
+        cache_dir = os.path.join(tmp, 'cache')
+        # The first run fills the caches, like every run after a merge but
+        # the first would find them.
+        measure_startup(built, cache_dir)
+        results = [measure_startup(built, cache_dir) for _ in range(max(1, repeat))]
+
+    fastest = min(results, key=lambda result: result['import'])
+    print('import validate: %.3fs (budget %.3fs)' % (fastest['import'], budget))
+    print('check for a winner: %.3fs' % min(result['winner'] for result in results))
+    print('whole process: %.3fs' % min(result['wall'] for result in results))
+
+    ok = fastest['import'] <= budget
+    forbidden = [module for module in STARTUP_FORBIDDEN_MODULES
+                 if any(module in result['modules'] for result in results)]
+    if forbidden:
+        print('Checking for a winner imported %s' % ', '.join(forbidden))
+        ok = False
+    return ok
+
+
+def check_views() -> bool:
+    # Returns whether rules' views of a PR are kept apart.
+    with tempfile.TemporaryDirectory(prefix='nomic-benchmark-') as tmp:
+        built = synthetic.generate(synthetic.DEFAULT_CONFIG._replace(stale_approvals=2),
+                                   os.path.join(tmp, 'build'))
+        env = dict(os.environ)
+        env.update(synthetic.environment(built))
+        env['NOMIC_CACHE_DIR'] = os.path.join(tmp, 'cache')
+        completed_process = subprocess.run(
+            [sys.executable, '-c', VIEWS_SCRIPT],
+            cwd=built.repo_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if completed_process.returncode != 0:
+        raise Exception('views check failed:\n%s' % completed_process.stderr.decode('utf-8'))
+    result = json.loads(completed_process.stdout.decode('utf-8').strip().split('\n')[-1])
+
+    ok = True
+    if not result['isolated']:
+        print('Changes made through one view of a PR are visible through another')
+        ok = False
+    if result['parses'] != 1:
+        print('The diff was parsed %s times instead of once' % result['parses'])
+        ok = False
+    if ok:
+        print('Views of a PR are kept apart, and the diff was parsed once')
+    return ok
+
+
+def benchmark(config: synthetic.Config, operations: List[str], repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory(prefix='nomic-benchmark-') as tmp:
+        built = synthetic.generate(config, os.path.join(tmp, 'build'))
+        for name in operations:
+            cold = []
+            warm = []
+            for i in range(repeat):
+                cache_dir = os.path.join(tmp, 'cache-%s-%s' % (name, i))
+                cold_result = run_measurement(built, name, cache_dir)
+                warm_result = run_measurement(built, name, cache_dir)
+                cold.append(cold_result['seconds'])
+                warm.append(warm_result['seconds'])
+            results.append(dict(config._asdict(), operation=name, cold=min(cold), warm=min(warm),
+                                outcome=warm_result['outcome']))
+    return results
+
+
+def configs(sizes: Dict[str, List[int]]) -> List[synthetic.Config]:
+    result = [synthetic.DEFAULT_CONFIG]
+    for field, values in sizes.items():
+        for value in values:
+            config = synthetic.DEFAULT_CONFIG._replace(**{field: value})
+            if config not in result:
+                result.append(config)
+    return result
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Time validate.py on synthetic repositories.')
+    parser.add_argument('--measure', choices=OPERATIONS, help=argparse.SUPPRESS)
+    for field, default in DEFAULT_SIZES.items():
+        parser.add_argument('--%s' % field.replace('_', '-'), default=default,
+                            help='comma separated sizes to try (default %s)' % default)
+    parser.add_argument('--operations', default=','.join(OPERATIONS))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='take the fastest of this many runs')
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--startup', action='store_true',
+                        help='instead, check how quickly checking for a winner starts, and exit 1 if too slowly')
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_STARTUP_BUDGET,
+                        help='seconds importing validate.py may take (default %s)' % DEFAULT_STARTUP_BUDGET)
+    parser.add_argument('--check-views', action='store_true',
+                        help="instead, check that rules can't change each other's view of a PR, and exit 1 if they can")
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure)
+        return
+
+    if args.startup:
+        if not check_startup(args.startup_budget, max(args.repeat, 5)):
+            sys.exit(1)
+        return
+
+    if args.check_views:
+        if not check_views():
+            sys.exit(1)
+        return
+
+    sizes = {field: [int(value) for value in getattr(args, field).split(',') if value]
+             for field in DEFAULT_SIZES}
+    operations = args.operations.split(',')
+
+    print('%7s %7s %7s %7s  %-13s %9s %9s  %s' % (
+        'players', 'merges', 'pages', 'stale', 'operation', 'cold', 'warm', 'outcome'))
+    all_results = []
+    for config in configs(sizes):
+        for result in benchmark(config, operations, args.repeat):
+            all_results.append(result)
+            print('%7s %7s %7s %7s  %-13s %8.3fs %8.3fs  %s' % (
+                result['players'], result['merges'], result['review_pages'], result['stale_approvals'],
+                result['operation'], result['cold'], result['warm'], result['outcome']))
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as outf:
+            json.dump(all_results, outf, indent=2)
+
+
+if __name__ == '__main__':
+    start()
@@ -0,0 +1,81 @@
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, Iterator
+
+
+# Everything we remember between runs lives under one directory.  By default
+# that's ~/.cache/nomic, which is shared by the master and proposed phases of a
+# build (validate-on-master.sh runs them in different checkouts) and survives
+# between local runs.  Set NOMIC_CACHE_DIR to put it somewhere else.
+def cache_dir(*parts: str) -> str:
+    root = os.environ.get('NOMIC_CACHE_DIR')
+    if not root:
+        root = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+            'nomic')
+
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    # Write to a temporary file next to the destination and rename it into
+    # place, so concurrent readers (and other builds) never see a partial file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as outf:
+            outf.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def locked(path: str) -> Iterator[None]:
+    # Holds an exclusive lock on path + '.lock' for the duration, so builds
+    # (and threads) sharing the cache take turns with whatever lives at path.
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def read_json(path: str, default: Any = None) -> Any:
+    # A missing or corrupt cache file is the same as an empty one.
+    try:
+        with open(path) as inf:
+            return json.load(inf)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path: str, value: Any) -> None:
+    write_atomic(path, json.dumps(value, sort_keys=True).encode('utf-8'))
+
+
+# Counters reported at the end of a run, like "http: 12 hits, 3 misses".
+_stats: Dict[str, Dict[str, int]] = {}
+_stats_lock = threading.Lock()
+
+
+def count(cache_name: str, outcome: str) -> None:
+    with _stats_lock:
+        outcomes = _stats.setdefault(cache_name, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+
+def print_stats() -> None:
+    with _stats_lock:
+        if not _stats:
+            return
+
+        print('\nCaches:')
+        for cache_name, outcomes in sorted(_stats.items()):
+            print('  %s: %s' % (cache_name, ', '.join(
+                '%s %s' % (n, outcome) for outcome, n in sorted(outcomes.items()))))
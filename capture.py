@@ -0,0 +1,77 @@
+import contextlib
+import io
+import sys
+import threading
+from typing import Callable, ContextManager, Iterator, TypeVar
+
+T = TypeVar('T')
+
+
+class _ThreadLocalStream:
+    # Stands in for sys.stdout or sys.stderr.  A thread that is capturing its
+    # output writes to its own buffer, and everything else goes to the real
+    # stream.
+    def __init__(self, real):
+        self._real = real
+        self._local = threading.local()
+
+    def _target(self):
+        buffer = getattr(self._local, 'buffer', None)
+        return self._real if buffer is None else buffer
+
+    def write(self, s: str) -> int:
+        return self._target().write(s)
+
+    def flush(self) -> None:
+        self._target().flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self._real, name)
+
+
+_install_lock = threading.Lock()
+
+
+def _install(name: str) -> _ThreadLocalStream:
+    with _install_lock:
+        stream = getattr(sys, name)
+        if not isinstance(stream, _ThreadLocalStream):
+            stream = _ThreadLocalStream(stream)
+            setattr(sys, name, stream)
+        return stream
+
+
+@contextlib.contextmanager
+def _writing_to(buffer: io.StringIO) -> Iterator[io.StringIO]:
+    streams = [_install('stdout'), _install('stderr')]
+
+    previous = [getattr(stream._local, 'buffer', None) for stream in streams]
+    for stream in streams:
+        stream._local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        for stream, previous_buffer in zip(streams, previous):
+            stream._local.buffer = previous_buffer
+
+
+def captured_output() -> ContextManager[io.StringIO]:
+    # Collect everything this thread prints, to stdout or stderr, without
+    # affecting other threads.
+    return _writing_to(io.StringIO())
+
+
+def propagating(fn: Callable[..., T]) -> Callable[..., T]:
+    # fn, for running on another thread, such as in a pool, with what it
+    # prints going wherever this thread's output is going now.  Threads don't
+    # otherwise share a capture, so without this what a pool prints on behalf
+    # of a captured rule would go straight to the terminal.
+    stdout = sys.stdout
+    buffer = getattr(stdout._local, 'buffer', None) if isinstance(stdout, _ThreadLocalStream) else None
+    if buffer is None:
+        return fn
+
+    def run(*args, **kwargs) -> T:
+        with _writing_to(buffer):
+            return fn(*args, **kwargs)
+    return run
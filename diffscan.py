@@ -0,0 +1,157 @@
+import re
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+# Header-level scanning of git diffs, for when we want to know which files a
+# diff touches without building a full unidiff.PatchSet.
+
+
+class DiffSummary(NamedTuple):
+    added: List[str]
+    modified: List[str]
+    removed: List[str]
+    lines_added: int
+    lines_removed: int
+
+
+def _strip_prefix(path: str) -> str:
+    if path.startswith('a/') or path.startswith('b/'):
+        return path[2:]
+    return path
+
+
+class _FileHeader:
+    def __init__(self, diff_git_line: str):
+        # "diff --git a/path b/path"; paths with spaces are ambiguous here, so
+        # prefer the ---/+++ lines when the diff has them.
+        source, _, target = diff_git_line[len('diff --git '):].partition(' b/')
+        self.source: Optional[str] = _strip_prefix(source)
+        self.target: Optional[str] = target
+        self.is_added = False
+        self.is_removed = False
+
+    def path(self) -> str:
+        if self.is_removed:
+            return self.source or ''
+        return self.target or self.source or ''
+
+
+def summarize(diff: str) -> DiffSummary:
+    summary = DiffSummary(added=[], modified=[], removed=[], lines_added=0, lines_removed=0)
+    lines_added = 0
+    lines_removed = 0
+
+    files: List[_FileHeader] = []
+    current: Optional[_FileHeader] = None
+    in_hunk = False
+
+    for line in diff.split('\n'):
+        if line.startswith('diff --git '):
+            current = _FileHeader(line)
+            files.append(current)
+            in_hunk = False
+        elif current is None:
+            continue
+        elif in_hunk:
+            if line.startswith('+'):
+                lines_added += 1
+            elif line.startswith('-'):
+                lines_removed += 1
+        elif line.startswith('@@'):
+            in_hunk = True
+        elif line.startswith('new file mode'):
+            current.is_added = True
+        elif line.startswith('deleted file mode'):
+            current.is_removed = True
+        elif line.startswith('--- '):
+            if line == '--- /dev/null':
+                current.is_added = True
+            else:
+                current.source = _strip_prefix(line[len('--- '):])
+        elif line.startswith('+++ '):
+            if line == '+++ /dev/null':
+                current.is_removed = True
+            else:
+                current.target = _strip_prefix(line[len('+++ '):])
+        elif line.startswith('rename to '):
+            current.target = line[len('rename to '):]
+
+    for file_header in files:
+        if file_header.is_added:
+            summary.added.append(file_header.path())
+        elif file_header.is_removed:
+            summary.removed.append(file_header.path())
+        else:
+            summary.modified.append(file_header.path())
+
+    return summary._replace(lines_added=lines_added, lines_removed=lines_removed)
+
+
+def file_diffs(diff: str) -> Iterator[str]:
+    # Each file's part of the diff, from its "diff --git" line up to the next
+    # one, one at a time.  Anything before the first file is skipped, as
+    # summarize does.
+    if diff.startswith('diff --git '):
+        start = 0
+    else:
+        start = diff.find('\ndiff --git ')
+        if start == -1:
+            return
+        start += 1
+
+    while start < len(diff):
+        end = diff.find('\ndiff --git ', start)
+        end = len(diff) if end == -1 else end + 1
+        yield diff[start:end]
+        start = end
+
+
+def _first_lines(text: str, count: int) -> Iterator[str]:
+    start = 0
+    for _ in range(count):
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def changes_existing_file(file_diff: str) -> bool:
+    # Whether unidiff would certainly count this file as modified or removed,
+    # going by its headers and first hunk header alone.  False if it might be
+    # an addition, or the headers are unusual, which only unidiff can settle.
+    for line in _first_lines(file_diff, 10):
+        if line.startswith('new file mode') or line == '--- /dev/null':
+            return False
+        if line.startswith('deleted file mode'):
+            return True
+        if line.startswith('@@ '):
+            # A single hunk from -0,0 is an addition even without the headers
+            # saying so.
+            return not line.startswith('@@ -0,0 ')
+    return False
+
+
+NEW_FILE_MODE_RE = re.compile(r'^new file mode \d+$')
+
+
+def new_one_line_file(file_diff: str) -> Optional[Tuple[str, str]]:
+    # For a new file of one line, which is what bonus files are, returns its
+    # path and its text as str(unidiff.PatchedFile) gives it, without parsing
+    # it with unidiff.  None for anything else.
+    if file_diff.count('\n') != 7 or not file_diff.endswith('\n'):
+        return None
+    header, mode, index, source, target, hunk, content, _ = file_diff.split('\n')
+    if not target.startswith('+++ b/'):
+        return None
+    path = target[len('+++ b/'):]
+    if (header != 'diff --git a/%s b/%s' % (path, path) or
+            any(c in path for c in ' \t"') or
+            not NEW_FILE_MODE_RE.match(mode) or
+            not index.startswith('index ') or
+            source != '--- /dev/null' or
+            hunk not in ['@@ -0,0 +1 @@', '@@ -0,0 +1,1 @@'] or
+            not content.startswith('+')):
+        return None
+    # unidiff always writes both lengths in hunk headers.
+    return path, '\n'.join([header, mode, index, source, target, '@@ -0,0 +1,1 @@', content, ''])
@@ -0,0 +1,45 @@
+from types import MappingProxyType
+from typing import Dict, FrozenSet, List, Mapping, NamedTuple, Optional, Tuple
+
+import tracing
+import util
+
+
+# Everything about the game that rules look at and that doesn't depend on the
+# PR: who is playing, their points, and when master last changed.  It's worked
+# out once per validation and every rule is handed the same snapshot, so
+# nothing in it can be changed: players are a tuple and a frozenset, and
+# points are read-only mappings.
+class GameState(NamedTuple):
+    users: Tuple[str, ...]  # Sorted, like util.users().
+    players: FrozenSet[str]
+    user_points: Mapping[str, Mapping[str, int]]  # Like util.get_user_points().
+    total_points: Mapping[str, int]
+    master_sha: str
+    master_ts: int
+    days_since_last_commit: int
+
+    def is_player(self, user: str) -> bool:
+        return user in self.players
+
+
+def build(users: List[str], user_points: Dict[str, Dict[str, int]], master_sha: str, master_ts: int,
+          now: Optional[float] = None) -> GameState:
+    # now is when to count days since the last commit up to, if not now.
+    return GameState(
+        users=tuple(users),
+        players=frozenset(users),
+        user_points=MappingProxyType({user: MappingProxyType(points_by_type)
+                                      for user, points_by_type in user_points.items()}),
+        total_points=MappingProxyType({user: util.total_user_points(points_by_type)
+                                       for user, points_by_type in user_points.items()}),
+        master_sha=master_sha,
+        master_ts=master_ts,
+        days_since_last_commit=util.days_since(master_ts) if now is None else util.seconds_to_days(
+            int(now - master_ts)))
+
+
+def snapshot() -> GameState:
+    # The game as of the checkout in the current directory.
+    with tracing.span('state', 'GameState'):
+        return build(util.users(), util.get_user_points(), util.last_commit_sha(), util.last_commit_ts())
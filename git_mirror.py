@@ -0,0 +1,199 @@
+import contextlib
+import fcntl
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import cache
+import replay
+import tracing
+
+
+class MergeFailed(Exception):
+    pass
+
+
+# A bare mirror of the game repo that lives in the cache directory and is kept
+# up to date with incremental fetches, instead of cloning the whole repo every
+# time we need to look at a commit.
+#
+# Only one fetch of master and one fetch per PR branch happens per process, no
+# matter how many commits we look at.
+class Mirror:
+    def __init__(self, repo: str, url: Optional[str] = None):
+        self.repo = repo
+        self.url = url or 'https://github.com/%s.git' % repo
+        self.path = cache.cache_dir('mirrors', '%s.git' % repo.replace('/', '-'))
+
+        self._lock = threading.RLock()
+        self._updated = False
+        self._remote_master: Optional[str] = None
+        self._fetched_branches: Set[Tuple[str, str]] = set()
+
+        if not os.path.exists(os.path.join(self.path, 'HEAD')):
+            self.git('init', '--bare', '--quiet')
+
+    def git(self, *args: str, check: bool = True) -> subprocess.CompletedProcess:
+        with tracing.span('git', 'git %s' % args[0], args=' '.join(args)) as span:
+            completed_process = subprocess.run(
+                ['git', '--git-dir', self.path] + list(args),
+                stdout=subprocess.PIPE)
+            span['returncode'] = completed_process.returncode
+        if check and completed_process.returncode != 0:
+            raise Exception(completed_process)
+        return completed_process
+
+    def git_output(self, *args: str) -> str:
+        return self.git(*args).stdout.decode('utf-8')
+
+    def update(self) -> None:
+        # Bring our copies of the upstream branches and tags up to date, like a
+        # fresh clone would have them.
+        with self._lock:
+            if self._updated:
+                return
+            self.git('fetch', '--quiet', '--prune', '--force', replay.git_url(self.url),
+                     '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+            replay.record_fetch(self.path, self.url, ['refs/heads/*:refs/heads/*',
+                                                      'refs/tags/*:refs/tags/*'])
+            self._updated = True
+
+    def refresh(self) -> None:
+        # For long-running processes: forget what we've fetched, so the next
+        # use fetches master and PR branches again.
+        with self._lock:
+            self._updated = False
+            self._remote_master = None
+            self._fetched_branches = set()
+
+    def master_sha(self) -> str:
+        self.update()
+        return self.git_output('rev-parse', 'refs/heads/master').strip()
+
+    def local_master_sha(self, expected: Optional[str] = None) -> str:
+        # master as the mirror already has it, with no network at all, unless
+        # it has no master yet or it isn't expected (the master of the
+        # checkout being validated), in which case the mirror is brought up to
+        # date first.
+        with self._lock:
+            completed_process = self.git('rev-parse', '--verify', '--quiet', 'refs/heads/master', check=False)
+            master = completed_process.stdout.decode('utf-8').strip()
+            if completed_process.returncode != 0 or (expected is not None and master != expected):
+                return self.master_sha()
+            return master
+
+    def remote_master_sha(self) -> str:
+        # What master is upstream right now?  Asks for just the one ref, which
+        # is much cheaper than fetching, and is only done once per process.
+        with self._lock:
+            # A recording needs master's commits, not just its sha, so when
+            # recording fetch instead.
+            if self._updated or replay.recording_dir():
+                return self.master_sha()
+            if self._remote_master is None:
+                line = self.git_output('ls-remote', replay.git_url(self.url),
+                                       'refs/heads/master').strip()
+                if not line:
+                    raise Exception('No master branch at %s' % self.url)
+                self._remote_master = line.split()[0]
+            return self._remote_master
+
+    def pr_branch_ref(self, remote_name: str, branch: str) -> str:
+        return 'refs/nomic/%s/%s' % (remote_name, branch)
+
+    def fetch_branch(self, remote_name: str, clone_url: str, branch: str) -> str:
+        # Fetch a PR's branch from the author's fork, and return the local ref
+        # we stored it under.
+        ref = self.pr_branch_ref(remote_name, branch)
+        with self._lock:
+            if (clone_url, branch) not in self._fetched_branches:
+                self.git('fetch', '--quiet', '--force', replay.git_url(clone_url),
+                         '+refs/heads/%s:%s' % (branch, ref))
+                replay.record_fetch(self.path, clone_url, ['%s:refs/heads/%s' % (ref, branch)])
+                self._fetched_branches.add((clone_url, branch))
+        return ref
+
+    def is_reachable(self, commit: str, refs: List[str]) -> bool:
+        # The mirror keeps commits around from earlier fetches, which a fresh
+        # clone plus a fetch of the PR branch wouldn't have.  Only look at
+        # commits that such a clone could see, so results don't depend on what
+        # happens to be cached.
+        completed_process = self.git('for-each-ref', '--count=1', '--contains', commit, *refs,
+                                     check=False)
+        return completed_process.returncode == 0 and bool(completed_process.stdout.strip())
+
+    def merge_tree(self, base: str, commit: str) -> str:
+        # Return the tree that merging commit into base would produce, without
+        # checking anything out.  Raises MergeFailed on conflicts.
+        completed_process = self.git('merge-tree', '--write-tree', base, commit, check=False)
+        if completed_process.returncode == 0:
+            return completed_process.stdout.decode('utf-8').split('\n', 1)[0].strip()
+        if completed_process.returncode == 1:
+            raise MergeFailed(commit)
+
+        # Older git has no --write-tree, so do the merge in a throwaway worktree.
+        return self._merge_tree_in_worktree(base, commit)
+
+    def _merge_tree_in_worktree(self, base: str, commit: str) -> str:
+        worktree = tempfile.mkdtemp(prefix='merge-', dir=cache.cache_dir('worktrees'))
+        try:
+            self.git('worktree', 'add', '--quiet', '--detach', worktree, base)
+            with tracing.span('git', 'git merge', args=commit):
+                completed_process = subprocess.run(
+                    ['git', '-c', 'user.name=nomic', '-c', 'user.email=nomic@localhost',
+                     'merge', '--quiet', '--no-edit', commit],
+                    cwd=worktree, stdout=subprocess.PIPE)
+            if completed_process.returncode != 0:
+                raise MergeFailed(commit)
+            with tracing.span('git', 'git rev-parse', args='HEAD^{tree}'):
+                return subprocess.check_output(
+                    ['git', 'rev-parse', 'HEAD^{tree}'], cwd=worktree).decode('utf-8').strip()
+        finally:
+            shutil.rmtree(worktree, ignore_errors=True)
+            self.git('worktree', 'prune', check=False)
+
+    @contextlib.contextmanager
+    def checkout(self, name: str, commit: str) -> Iterator[str]:
+        # A worktree with commit checked out, as a fresh clone at that commit
+        # would have it.  It's kept in the cache directory between runs, so
+        # moving it to a new commit only rewrites the files that changed, and
+        # it's locked while in use in case another build wants it too.
+        path = os.path.join(cache.cache_dir('worktrees'), name)
+        with open(path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with tracing.span('git', 'checkout %s' % name, commit=commit):
+                if not self._reset_worktree(path, commit):
+                    # Missing, or left over from a mirror that's since been
+                    # replaced: start again.
+                    shutil.rmtree(path, ignore_errors=True)
+                    self.git('worktree', 'prune', check=False)
+                    self.git('worktree', 'add', '--quiet', '--detach', path, commit)
+            yield path
+
+    def _reset_worktree(self, path: str, commit: str) -> bool:
+        if not os.path.exists(os.path.join(path, '.git')):
+            return False
+        for args in [['checkout', '--quiet', '--force', '--detach', commit],
+                     ['clean', '--quiet', '-ffdx']]:
+            if subprocess.run(['git'] + args, cwd=path, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).returncode != 0:
+                return False
+        return True
+
+    def diff(self, old: str, new: str) -> str:
+        return self.git_output('diff', old, new)
+
+
+_mirrors: Dict[str, Mirror] = {}
+_mirrors_lock = threading.Lock()
+
+
+def mirror(repo: str) -> Mirror:
+    # One mirror object per repo per process, so fetches are shared.
+    with _mirrors_lock:
+        if repo not in _mirrors:
+            _mirrors[repo] = Mirror(repo)
+        return _mirrors[repo]
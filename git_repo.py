@@ -0,0 +1,163 @@
+import os
+import re
+import subprocess
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import tracing
+
+_SHA_RE = re.compile('^[0-9a-f]{40}$')
+
+
+class MissingObject(Exception):
+    pass
+
+
+class Commit(NamedTuple):
+    sha: str
+    tree: str
+    parents: List[str]
+    committer_ts: int
+    subject: str
+
+
+def parse_commit(sha: str, data: bytes) -> Commit:
+    header, _, message = data.decode('utf-8', 'replace').partition('\n\n')
+
+    tree = ''
+    parents: List[str] = []
+    committer_ts = 0
+    for line in header.split('\n'):
+        key, _, value = line.partition(' ')
+        if key == 'tree':
+            tree = value
+        elif key == 'parent':
+            parents.append(value)
+        elif key == 'committer':
+            # "committer Name <email> 1516291200 -0500"
+            committer_ts = int(value.rsplit(' ', 2)[1])
+
+    # Like git log's %s: the first paragraph of the message, on one line.
+    subject_lines: List[str] = []
+    for line in message.split('\n'):
+        if not line.strip():
+            if subject_lines:
+                break
+            continue
+        subject_lines.append(line.strip())
+
+    return Commit(sha=sha, tree=tree, parents=parents, committer_ts=committer_ts,
+                  subject=' '.join(subject_lines))
+
+
+class TreeEntry(NamedTuple):
+    mode: str
+    name: str
+    sha: str
+
+    def is_tree(self) -> bool:
+        return self.mode == '40000'
+
+
+def parse_tree(data: bytes) -> List[TreeEntry]:
+    # Tree objects are a series of "<mode> <name>\0<20 byte sha>".
+    entries = []
+    i = 0
+    while i < len(data):
+        space = data.index(b' ', i)
+        nul = data.index(b'\0', space)
+        entries.append(TreeEntry(mode=data[i:space].decode('ascii'),
+                                 name=data[space + 1:nul].decode('utf-8', 'surrogateescape'),
+                                 sha=data[nul + 1:nul + 21].hex()))
+        i = nul + 21
+    return entries
+
+
+# Reads objects out of a repository through one long-running
+# `git cat-file --batch`, instead of starting a new git process for every
+# question we have.  Objects are immutable, so anything we look up by sha is
+# remembered for the life of the process.  Names like "master" are resolved
+# fresh each time, since refs can move.
+class Repository:
+    def __init__(self, path: str = '.'):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        self._process: Optional[subprocess.Popen] = None
+        self._objects: Dict[str, Tuple[str, str, bytes]] = {}
+
+    def _cat_file(self) -> subprocess.Popen:
+        if self._process is None or self._process.poll() is not None:
+            self._process = subprocess.Popen(
+                ['git', 'cat-file', '--batch'], cwd=self.path,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return self._process
+
+    def read(self, rev: str) -> Tuple[str, str, bytes]:
+        # Returns (sha, object type, contents).
+        if rev in self._objects:
+            return self._objects[rev]
+
+        with self._lock, tracing.span('git', 'git cat-file', args=rev):
+            process = self._cat_file()
+            assert process.stdin is not None and process.stdout is not None
+            process.stdin.write(rev.encode('utf-8') + b'\n')
+            process.stdin.flush()
+
+            header = process.stdout.readline().decode('utf-8').split()
+            if len(header) != 3:
+                raise MissingObject('git cat-file: %s' % ' '.join(header))
+            sha, object_type, size = header
+            data = process.stdout.read(int(size))
+            process.stdout.read(1)  # trailing newline
+
+        result = (sha, object_type, data)
+        self._objects[sha] = result
+        return result
+
+    def resolve(self, rev: str) -> str:
+        if _SHA_RE.match(rev):
+            return rev
+        sha, _, _ = self.read(rev)
+        return sha
+
+    def commit(self, rev: str) -> Commit:
+        sha, object_type, data = self.read(rev)
+        if object_type != 'commit':
+            raise Exception('%s is a %s, not a commit' % (rev, object_type))
+        return parse_commit(sha, data)
+
+    def tree(self, rev: str) -> List[TreeEntry]:
+        # rev can be a tree, or a commit to get its top-level tree.
+        sha, object_type, data = self.read(rev)
+        if object_type == 'commit':
+            sha, object_type, data = self.read(parse_commit(sha, data).tree)
+        if object_type != 'tree':
+            raise Exception('%s is a %s, not a tree' % (rev, object_type))
+        return parse_tree(data)
+
+    def blob(self, rev: str) -> bytes:
+        _, object_type, data = self.read(rev)
+        if object_type != 'blob':
+            raise Exception('%s is a %s, not a blob' % (rev, object_type))
+        return data
+
+    def close(self) -> None:
+        with self._lock:
+            if self._process is not None:
+                assert self._process.stdin is not None
+                self._process.stdin.close()
+                self._process.wait()
+                self._process = None
+
+
+_repositories: Dict[str, Repository] = {}
+_repositories_lock = threading.Lock()
+
+
+def repository(path: str = '.') -> Repository:
+    # One reader per repository per process.
+    path = os.path.abspath(path)
+    with _repositories_lock:
+        if path not in _repositories:
+            _repositories[path] = Repository(path)
+        return _repositories[path]
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import cache
+
+# On-disk cache of GET responses, keyed by URL.  We remember each response's
+# ETag and Last-Modified, send them back as If-None-Match and If-Modified-Since,
+# and when the server answers 304 Not Modified we serve the body from disk.
+# GitHub doesn't count 304s against the 5000/hr limit, and the diff and
+# review pages for a PR rarely change between Travis restarts.
+#
+# The cache is capped at NOMIC_HTTP_CACHE_MAX_BYTES (default 100MB, same as the
+# proxy), evicting least recently used entries first.
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+# Headers that describe the bytes on the wire rather than the body we store.
+# requests has already undone any compression by the time we see the body.
+_SKIP_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+
+class Entry(NamedTuple):
+    url: str
+    headers: Dict[str, str]
+    body_path: str
+    meta_path: str
+
+    def validators(self) -> Dict[str, str]:
+        validators = {}
+        for header, conditional in [('etag', 'If-None-Match'),
+                                    ('last-modified', 'If-Modified-Since')]:
+            if header in self.headers:
+                validators[conditional] = self.headers[header]
+        return validators
+
+    def body(self) -> bytes:
+        with open(self.body_path, 'rb') as inf:
+            return inf.read()
+
+
+_evict_lock = threading.Lock()
+
+
+def _directory() -> str:
+    return cache.cache_dir('http')
+
+
+def _max_bytes() -> int:
+    return int(os.environ.get('NOMIC_HTTP_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+
+def _paths(url: str) -> Tuple[str, str]:
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    base = os.path.join(_directory(), key)
+    return base + '.json', base + '.body'
+
+
+def lookup(url: str) -> Optional[Entry]:
+    meta_path, body_path = _paths(url)
+    meta = cache.read_json(meta_path)
+    if not meta or meta.get('url') != url or not os.path.exists(body_path):
+        return None
+    return Entry(url=url, headers=meta['headers'], body_path=body_path, meta_path=meta_path)
+
+
+def _touch(entry: Entry) -> None:
+    # Eviction goes by mtime, so bump it on every use.
+    try:
+        os.utime(entry.meta_path)
+        os.utime(entry.body_path)
+    except OSError:
+        pass
+
+
+def _stored_headers(headers) -> Dict[str, str]:
+    return {header.lower(): value for header, value in headers.items()
+            if header.lower() not in _SKIP_HEADERS}
+
+
+def store(url: str, headers, body: bytes) -> Optional[Entry]:
+    stored_headers = _stored_headers(headers)
+    if 'etag' not in stored_headers and 'last-modified' not in stored_headers:
+        # Nothing to revalidate with, so there's no point keeping it.
+        return None
+
+    meta_path, body_path = _paths(url)
+    cache.write_atomic(body_path, body)
+    cache.write_json(meta_path, {'url': url, 'headers': stored_headers})
+    _evict()
+    return Entry(url=url, headers=stored_headers, body_path=body_path, meta_path=meta_path)
+
+
+def revalidated(entry: Entry, headers) -> Entry:
+    # A 304 may carry updated headers (a new Date, rate limit counters, ...).
+    # Fold them into what we have stored so the cached copy stays current.
+    updated_headers = dict(entry.headers)
+    updated_headers.update(_stored_headers(headers))
+    if updated_headers != entry.headers:
+        cache.write_json(entry.meta_path, {'url': entry.url, 'headers': updated_headers})
+    _touch(entry)
+    return entry._replace(headers=updated_headers)
+
+
+def _evict() -> None:
+    with _evict_lock:
+        directory = _directory()
+        files = []
+        total = 0
+        for fname in os.listdir(directory):
+            path = os.path.join(directory, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, path, st.st_size))
+            total += st.st_size
+
+        max_bytes = _max_bytes()
+        for _, path, size in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import cache
+import git_repo
+
+# Only look at PRs merged since restarting the game.
+RESTART_COMMIT = 'e5229a56a942126dc35c463d0f94f348b3d5389a'
+
+# This can't fully be trusted, since it's under the control of the person who
+# merges the PR, except that editing the merge text on GitHub is out of
+# bounds.
+MERGE_REGEXP = '^Merge pull request #[\\d]* from ([^/]*)/'
+
+# How many master commits to keep merge counts for.  We only need the most
+# recent one we've seen, but builds of different branches and forks share the
+# cache and shouldn't throw each other's work away.
+MAX_LEDGER_ENTRIES = 50
+
+
+def merge_author(commit_subject: str) -> Optional[str]:
+    match = re.match(MERGE_REGEXP, commit_subject)
+    if match:
+        # Regexp match means this is a merge commit.
+        commit_username, = match.groups()
+        return commit_username
+    return None
+
+
+# The ledger records, for master commits we've seen before, how many merges
+# each username had as of that commit.  Those counts never change for a given
+# commit, so to count merges at a new master we only need to walk back through
+# the first-parent history until we reach a commit we already know about.
+class Ledger:
+    def __init__(self) -> None:
+        self._path = os.path.join(cache.cache_dir('points'), 'ledger.json')
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = cache.read_json(self._path, default={})
+
+    def merge_counts(self, master_sha: str) -> Dict[str, int]:
+        with self._lock:
+            if master_sha in self._entries:
+                cache.count('points ledger', 'hits')
+                return dict(self._entries[master_sha]['merges'])
+
+            known_sha, new_merges = _count_merges(master_sha, stop_at=self._entries)
+            merges = dict(self._entries[known_sha]['merges']) if known_sha else {}
+            for username, n in new_merges.items():
+                merges[username] = merges.get(username, 0) + n
+            cache.count('points ledger', 'misses')
+
+            if os.environ.get('NOMIC_VERIFY_POINTS'):
+                _, rescanned_merges = _count_merges(master_sha, stop_at={})
+                if rescanned_merges != merges:
+                    raise Exception('Points ledger disagrees with a full rescan at %s: %s vs %s' % (
+                        master_sha, merges, rescanned_merges))
+
+            self._entries[master_sha] = {'merges': merges, 'used': int(time.time())}
+            self._save()
+            return dict(merges)
+
+    def _save(self) -> None:
+        recent = sorted(self._entries, key=lambda sha: self._entries[sha].get('used', 0))
+        for sha in recent[:-MAX_LEDGER_ENTRIES]:
+            del self._entries[sha]
+        cache.write_json(self._path, self._entries)
+
+
+def _count_merges(master_sha: str, stop_at) -> Tuple[Optional[str], Dict[str, int]]:
+    # Iterate through commits in reverse chronological order, counting merges
+    # by PR author, until we reach the game restart or a commit in stop_at.
+    # Returns which commit in stop_at we stopped at, if any.
+    #
+    # We only look at master, and we look at the --first-parent history which
+    # just shows the merges: http://www.davidchudzicki.com/posts/first-parent/
+    repository = git_repo.repository()
+    merges: Dict[str, int] = {}
+
+    sha: Optional[str] = master_sha
+    while sha:
+        if sha == RESTART_COMMIT:
+            return None, merges
+
+        if sha in stop_at:
+            return sha, merges
+
+        try:
+            commit = repository.commit(sha)
+        except git_repo.MissingObject:
+            if sha == master_sha:
+                raise
+            break  # The history in a shallow clone stops early, like git log does.
+
+        commit_username = merge_author(commit.subject)
+        if commit_username:
+            merges[commit_username] = merges.get(commit_username, 0) + 1
+
+        sha = commit.parents[0] if commit.parents else None
+
+    return None, merges
+
+
+# Reading bonuses straight from git objects lets us get points at any
+# revision without checking it out.  Totals are remembered by the sha of the
+# tree they came from, and trees with the same contents have the same sha, so
+# a players/ directory (or one player's bonuses) that didn't change between
+# two revisions is only read once.
+_bonuses_by_players_tree: Dict[str, Dict[str, int]] = {}
+_bonus_by_bonuses_tree: Dict[str, int] = {}
+
+
+def _bonus_total(repository: git_repo.Repository, bonuses_tree: str) -> int:
+    if bonuses_tree not in _bonus_by_bonuses_tree:
+        _bonus_by_bonuses_tree[bonuses_tree] = sum(
+            int(repository.blob(entry.sha).decode('utf-8'))
+            for entry in repository.tree(bonuses_tree) if not entry.is_tree())
+    return _bonus_by_bonuses_tree[bonuses_tree]
+
+
+def _player_bonuses(repository: git_repo.Repository, players_tree: str) -> Dict[str, int]:
+    # username -> total bonus, for each directory in players/
+    if players_tree not in _bonuses_by_players_tree:
+        bonuses = {}
+        for player in repository.tree(players_tree):
+            if not player.is_tree():
+                continue
+            bonuses[player.name] = 0
+            for entry in repository.tree(player.sha):
+                if entry.name == 'bonuses' and entry.is_tree():
+                    bonuses[player.name] = _bonus_total(repository, entry.sha)
+        _bonuses_by_players_tree[players_tree] = bonuses
+    return _bonuses_by_players_tree[players_tree]
+
+
+def bonuses_at(rev: str, repository: Optional[git_repo.Repository] = None) -> Dict[str, int]:
+    repository = repository or git_repo.repository()
+    for entry in repository.tree(rev):
+        if entry.name == 'players' and entry.is_tree():
+            return _player_bonuses(repository, entry.sha)
+    return {}
+
+
+def _standings(bonuses: Dict[str, int], merges: Dict[str, int]) -> Dict[str, Dict[str, int]]:
+    # Shaped like util.get_user_points.
+    return {user: {'bonus': bonuses[user], 'merge': merges.get(user, 0)}
+            for user in sorted(bonuses)}
+
+
+def user_points_at(rev: str) -> Dict[str, Dict[str, int]]:
+    # Points as of any commit: bonuses from that commit's tree, and merges
+    # from its first-parent history.
+    repository = git_repo.repository()
+    sha = repository.resolve(rev)
+    return _standings(bonuses_at(sha, repository), merge_counts(sha))
+
+
+class Standing(NamedTuple):
+    sha: str
+    committer_ts: int
+    subject: str
+    points: Dict[str, Dict[str, int]]
+
+
+def timeline(rev: str = 'master') -> List[Standing]:
+    # Points after each merge since the restart, oldest first, in one pass
+    # over the first-parent history.  The last entry is always rev itself.
+    repository = git_repo.repository()
+    head = repository.resolve(rev)
+
+    commits: List[git_repo.Commit] = []
+    sha: Optional[str] = head
+    while sha and sha != RESTART_COMMIT:
+        try:
+            commit = repository.commit(sha)
+        except git_repo.MissingObject:
+            if sha == head:
+                raise
+            break  # A shallow clone's history stops early.
+        commits.append(commit)
+        sha = commit.parents[0] if commit.parents else None
+
+    standings = []
+    merges: Dict[str, int] = {}
+    for commit in reversed(commits):
+        commit_username = merge_author(commit.subject)
+        if commit_username:
+            merges[commit_username] = merges.get(commit_username, 0) + 1
+        if commit_username or commit.sha == head:
+            standings.append(Standing(
+                sha=commit.sha, committer_ts=commit.committer_ts, subject=commit.subject,
+                points=_standings(bonuses_at(commit.sha, repository), merges)))
+    return standings
+
+
+_ledger: Optional[Ledger] = None
+_ledger_lock = threading.Lock()
+
+
+def ledger() -> Ledger:
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger()
+        return _ledger
+
+
+def merge_counts(master_sha: str) -> Dict[str, int]:
+    return ledger().merge_counts(master_sha)
@@ -1,43 +1,283 @@
-from typing import Dict, List, Optional, Tuple
-import subprocess
-import unidiff
-import shutil
+from typing import TYPE_CHECKING, Dict, FrozenSet, List, Optional, Set, Tuple
+import copy
 import os
+import threading
+import types
+import urllib.parse
+import approval_index
+import cache
+import diffscan
+import git_mirror
+import tracing
 import util
 
+# Only rules that look at the diff need unidiff, so it's imported the first
+# time one does.  requests is imported by util when the first request is made.
+if TYPE_CHECKING:
+    import requests
+    import unidiff
+
+
+def pulls_url(repo: str) -> str:
+    # This is configured in nginx like:
+    #
+    # proxy_cache_path
+    #     /tmp/github-proxy
+    #     levels=1:2
+    #     keys_zone=github-proxy:1m
+    #     max_size=100m;
+    #
+    # server {
+    #   ...
+    #   location /nomic-github/repos/jeffkaufman/nomic/pulls {
+    #     if ($request_method != GET) {
+    #       return 403;
+    #     }
+    #
+    #     proxy_cache github-proxy;
+    #     proxy_ignore_headers Cache-Control Vary;
+    #     proxy_cache_valid any 1m;
+    #     proxy_pass https://api.github.com/repos/jeffkaufman/nomic/pulls;
+    #     proxy_set_header
+    #         Authorization
+    #         "Basic [base64 of 'username:token']";
+    #   }
+    #
+    # Where the token is a github personal access token:
+    #   https://github.com/settings/tokens
+    #
+    # There's an API limit of 60/hr per IP by default, and 5000/hr by
+    # user, and we need the higher limit.
+    #
+    # Responses are cached for one minute by this proxy.  The caching is
+    # optional, but now that https:/www.jefftk.com/nomic is available and
+    # world-accessible it could potentially get hit by substantial traffic.  At a
+    # 60s cache and 5k/hr limit we can have 83 GitHub API requests per page
+    # render and not go down.  As of 2018-01-18 there are eight open PRs, each
+    # of which needs a request to get reviews, so we're ok by a factor of 10.  If
+    # we have a lot of old open PRs we don't care about we could either close
+    # them or make the dashboard only gather reviews for PRs in the "reviewme"
+    # state.
+    return 'https://www.jefftk.com/nomic-github/repos/%s/pulls' % repo
+
+
+def _copy_patch_set(patch_set: 'unidiff.PatchSet') -> 'unidiff.PatchSet':
+    # A copy of a parsed diff that shares nothing that can be changed with
+    # the original.  Copying each file, hunk and line directly takes about a
+    # quarter of the time parsing the text again does, and a tenth of what
+    # deepcopy does.
+    def clone(value):
+        new_value = value.__class__.__new__(value.__class__)
+        new_value.__dict__.update(value.__dict__)
+        return new_value
+
+    new_patch_set = clone(patch_set)
+    for patched_file in patch_set:
+        new_file = clone(patched_file)
+        if patched_file.patch_info is not None:
+            new_file.patch_info = copy.copy(patched_file.patch_info)
+        for hunk in patched_file:
+            new_hunk = clone(hunk)
+            list.extend(new_hunk, [clone(line) for line in hunk])
+            list.append(new_file, new_hunk)
+        list.append(new_patch_set, new_file)
+    return new_patch_set
+
+
+class SharedDiff:
+    # A PR's diff at one commit.  It's fetched once and parsed at most once,
+    # and then shared read-only by every copy of the PR, which is why deepcopy
+    # hands back the same object.  Rules get their own copy(), which copies
+    # the parsed diff the first time a rule asks for it.
+    def __init__(self, text: str, original: Optional['SharedDiff'] = None):
+        self.text = text
+        self._original = original
+        self._lock = threading.Lock()
+        self._patch_set: Optional['unidiff.PatchSet'] = None
+        self._summary: Optional[diffscan.DiffSummary] = None
+
+    def __deepcopy__(self, memo) -> 'SharedDiff':
+        return self
+
+    def copy(self) -> 'SharedDiff':
+        return SharedDiff(self.text, original=self)
+
+    def patch_set(self) -> 'unidiff.PatchSet':
+        with self._lock:
+            if self._patch_set is None:
+                if self._original is not None:
+                    self._patch_set = _copy_patch_set(self._original.patch_set())
+                else:
+                    import unidiff
+                    self._patch_set = unidiff.PatchSet(self.text)
+            return self._patch_set
+
+    def summary(self) -> diffscan.DiffSummary:
+        with self._lock:
+            if self._summary is None:
+                if self._original is not None:
+                    summary = self._original.summary()
+                    self._summary = summary._replace(added=list(summary.added), modified=list(summary.modified),
+                                                     removed=list(summary.removed))
+                else:
+                    self._summary = diffscan.summarize(self.text)
+            return self._summary
+
+
+# (repo, pr number, target commit) -> diff
+_shared_diffs: Dict[Tuple[str, str, str], SharedDiff] = {}
+_shared_diffs_lock = threading.Lock()
+
+
+def forget_shared_diffs(keep: Set[Tuple[str, str, str]]) -> None:
+    # For long-running processes, so diffs of commits no one is looking at
+    # any more don't pile up.  keep is the commit_key()s still wanted.
+    with _shared_diffs_lock:
+        for key in list(_shared_diffs):
+            if key not in keep:
+                del _shared_diffs[key]
+
+
+def share_diff(key: Tuple[str, str, str], text: str) -> None:
+    # Use text as the diff of the PR with commit_key() key, instead of
+    # downloading it.
+    with _shared_diffs_lock:
+        _shared_diffs.setdefault(key, SharedDiff(text))
+
 
 class PullRequest:
-    def __init__(self, repo: str, pr_number: str, target_commit: str, users: List[str]):
+    def __init__(self, repo: str, pr_number: str, target_commit: str, users: List[str],
+                 pr_json: Optional[Dict] = None, prefetch_reviews: bool = True):
         self._repo = repo
         self._pr_number = pr_number
         self._target_commit = target_commit
         self._users = users
-        self._pr_json = util.request(self._base_pr_url()).json()
-        self._clone_url = self._pr_json['head']['repo']['clone_url']
-        self._ref = self._pr_json['head']['ref']
-
-        # commit hash -> diff at commit; lazily built
-        self._commit_diffs: Dict[str, str] = {}
-
-        # Hash from user names to booleans representing whether the user has
-        # approved or rejected the PR.
-        self.reviews = self._calculate_reviews()
-
-        if self.author() in users:
-            self.reviews[self.author()] = True
-
-        self.approvals: List[str] = []
-        self.rejections: List[str] = []
-        for user in users:
-            if user in self.reviews:
-                if self.reviews[user]:
-                    self.approvals.append(user)
-                else:
-                    self.rejections.append(user)
 
-        self.non_participants = [user for user in users
-                                 if user not in self.approvals
-                                 and user not in self.rejections]
+        with tracing.span('pr', 'PullRequest #%s' % pr_number, commit=target_commit):
+            # The PR itself, the first page of reviews, and the diff don't depend on
+            # each other, so fetch whichever we need all at once.  Reviews are only
+            # worked out when something asks for them, but when we know they'll be
+            # wanted it's cheaper to get the first page now.
+            urls = []
+            if pr_json is None:
+                urls.append(self._base_pr_url())
+            if prefetch_reviews:
+                urls.append(self._reviews_url())
+            with _shared_diffs_lock:
+                need_diff = self.commit_key() not in _shared_diffs
+            if need_diff:
+                urls.append(self._diff_url())
+
+            responses = util.request_all(urls)
+            if pr_json is None:
+                pr_json = responses.pop(0).json()
+            self._reviews_response = responses.pop(0) if prefetch_reviews else None
+            if need_diff:
+                self._remember_diff(responses.pop(0).content.decode('utf-8'))
+
+            self._pr_json = pr_json
+            self._clone_url = self._pr_json['head']['repo']['clone_url']
+            self._ref = self._pr_json['head']['ref']
+
+        # commit hash -> fingerprint of diff at commit; lazily built
+        self._commit_fingerprints: Dict[str, Optional[str]] = {}
+
+        self._reviews_lock = threading.Lock()
+        # Every review on the PR, in the order they were given, as (user,
+        # state, commit).
+        self._raw_reviews: Optional[List[Tuple[str, str, str]]] = None
+        self._reviews: Optional[Dict[str, bool]] = None
+        self._approvals: List[str] = []
+        self._rejections: List[str] = []
+        self._non_participants: List[str] = []
+        self._approval_set: FrozenSet[str] = frozenset()
+        self._rejection_set: FrozenSet[str] = frozenset()
+
+    def _load_reviews(self) -> None:
+        with self._reviews_lock:
+            if self._reviews is not None:
+                return
+
+            # Hash from user names to booleans representing whether the user has
+            # approved or rejected the PR.
+            reviews = self._calculate_reviews(self._all_reviews())
+
+            if self.author() in self._users:
+                reviews[self.author()] = True
+
+            for user in self._users:
+                if user in reviews:
+                    if reviews[user]:
+                        self._approvals.append(user)
+                    else:
+                        self._rejections.append(user)
+
+            self._approval_set = frozenset(self._approvals)
+            self._rejection_set = frozenset(self._rejections)
+            self._non_participants = [user for user in self._users
+                                      if user not in self._approval_set
+                                      and user not in self._rejection_set]
+            self._reviews = reviews
+
+    def _all_reviews(self) -> List[Tuple[str, str, str]]:
+        # Called with _reviews_lock held.
+        if self._raw_reviews is None:
+            reviews_response = self._reviews_response
+            if reviews_response is None:
+                reviews_response = util.request(self._reviews_url())
+            self._reviews_response = None
+            self._raw_reviews = self._fetch_reviews(reviews_response)
+        return self._raw_reviews
+
+    def for_users(self, users: List[str]) -> 'PullRequest':
+        # This PR as seen with a different list of players, for validating by
+        # master's rules and then by the proposed ones.  Nothing is fetched
+        # again: the PR, its diff, and its reviews are shared, and only which
+        # reviews count is worked out afresh.
+        with self._reviews_lock:
+            raw_reviews = self._all_reviews()
+
+        pr = PullRequest(repo=self._repo,
+                         pr_number=self._pr_number,
+                         target_commit=self._target_commit,
+                         users=users,
+                         pr_json=self._pr_json,
+                         prefetch_reviews=False)
+        pr._raw_reviews = raw_reviews
+        pr._commit_fingerprints = self._commit_fingerprints
+        return pr
+
+    @property
+    def reviews(self) -> Dict[str, bool]:
+        self._load_reviews()
+        assert self._reviews is not None
+        return self._reviews
+
+    @property
+    def approvals(self) -> List[str]:
+        self._load_reviews()
+        return self._approvals
+
+    @property
+    def rejections(self) -> List[str]:
+        self._load_reviews()
+        return self._rejections
+
+    # The same as approvals and rejections, for checking membership.
+    @property
+    def approval_set(self) -> FrozenSet[str]:
+        self._load_reviews()
+        return self._approval_set
+
+    @property
+    def rejection_set(self) -> FrozenSet[str]:
+        self._load_reviews()
+        return self._rejection_set
+
+    @property
+    def non_participants(self) -> List[str]:
+        self._load_reviews()
+        return self._non_participants
 
     def created_at_ts(self) -> int:
         return util.iso8601_to_ts(self._pr_json['created_at'])
@@ -58,104 +298,147 @@ class PullRequest:
     def days_since_changed(self) -> int:
         return util.days_since(self.last_changed_ts())
 
-    def _calculate_diff_at_commit(self, commit: str) -> str:
+    def _calculate_diff_at_commit(self, master: str, commit: str) -> Optional[str]:
         # Determine what changes this commit makes relative to master.
         #
-        # I don't know a git command directly for it, so instead make a temporary
-        # repo, load all relevant commits into the repo, merge the commit in
-        # question into master, and then diff against origin/master.
+        # I don't know a git command directly for it, so instead load all
+        # relevant commits into our mirror of the repo, merge the commit in
+        # question into master without checking anything out, and then diff the
+        # result against master.
+        #
+        # Returns '' if the commit can't be merged into master, and None if we
+        # couldn't find out (ex: fetching failed).
 
-        print('Calculating diff at %s' % commit)
-        original_working_directory = os.getcwd()
-        tmp_repo_fname = 'tmp-repo'
-        try:
-            # Make a new clone to work in.
-            subprocess.check_call([
-                'git', 'clone',
-                'https://github.com/%s.git' % self._repo, tmp_repo_fname])
-            os.chdir(tmp_repo_fname)
-            remote_name = self.author()
+        with tracing.span('pr', 'diff at %s' % commit, pr=self._pr_number):
+            print('Calculating diff at %s' % commit)
+            mirror = git_mirror.mirror(self._repo)
+            try:
+                # We can't refer to commit until we download it.
+                pr_branch = mirror.fetch_branch(self.author(), self._clone_url, self._ref)
+            except Exception:
+                print('Failed to get diff at %s' % commit)
+                return None
 
-            # We can't refer to commit until we download it.
-            subprocess.check_call(['git', 'remote', 'add', remote_name, self._clone_url])
-            subprocess.check_call(['git', 'fetch', remote_name, self._ref])
-            subprocess.check_call(['git', 'merge', '--no-edit', commit])
+            try:
+                if not mirror.is_reachable(commit, ['refs/heads', 'refs/tags', pr_branch]):
+                    raise Exception('%s is not on master or %s' % (commit, self._ref))
 
-            completed_process = subprocess.run(
-                ['git', 'diff', 'origin/master'], stdout=subprocess.PIPE)
-            if completed_process.returncode != 0:
-                raise Exception(completed_process)
+                return mirror.diff(master, mirror.merge_tree(master, commit))
 
-            return completed_process.stdout.decode('utf-8')
+            except Exception:
+                print('Failed to get diff at %s' % commit)
+                return ''
+
+    def _fingerprint_at_commit(self, master: str, commit: str) -> Optional[str]:
+        if commit not in self._commit_fingerprints:
+            index = approval_index.for_repo(self._repo)
+            fingerprint = index.fingerprint(master, commit)
+            if fingerprint is None:
+                diff = self._calculate_diff_at_commit(master, commit)
+                if diff is not None:
+                    fingerprint = approval_index.fingerprint(diff) if diff else ''
+                    index.set_fingerprint(master, commit, fingerprint)
+            self._commit_fingerprints[commit] = fingerprint
+
+        return self._commit_fingerprints[commit]
 
+    def _pr_diff_identical(self, commit_a: str, commit_b: str) -> bool:
+        # Decisions are remembered across runs, keyed by the master they were
+        # made against, so re-checking an already checked PR needs no network
+        # and no git work beyond reading the mirror's master.  That's fetched
+        # first only if it isn't the master checked out here.
+        mirror = git_mirror.mirror(self._repo)
+        index = approval_index.for_repo(self._repo)
+        try:
+            try:
+                checkout_master: Optional[str] = util.last_commit_sha()
+            except Exception:
+                checkout_master = None
+            master = mirror.local_master_sha(checkout_master)
+
+            decision = index.decision(master, commit_a, commit_b)
+            if decision is not None:
+                cache.count('approvals', 'hits')
+                return decision
+            cache.count('approvals', 'misses')
         except Exception:
-            print('Failed to get diff at %s' % commit)
-            return ''
-
-        finally:
-            # This runs even if we return above, and puts us back in the state we
-            # were in before we tried to calculate the diff.
-
-            os.chdir(original_working_directory)
-            if os.path.exists(tmp_repo_fname):
-
-                # rmtree can fail on Windows if files are set to readonly
-                def remove_readonly(func, path, _):
-                    # Clear the readonly bit and reattempt the removal
-                    os.chmod(path, stat.S_IWRITE)
-                    func(path)
-
-                shutil.rmtree(tmp_repo_fname, onerror=remove_readonly)
-
-    def _diff_at_commit(self, commit: str) -> str:
-        if commit not in self._commit_diffs:
-            self._commit_diffs[commit] = self._calculate_diff_at_commit(commit)
-
-        return self._commit_diffs[commit]
+            print('Failed to get diff at %s' % commit_a)
+            return False
 
-    def _pr_diff_identical(self, commit_a: str, commit_b: str) -> bool:
-        diff_a = self._diff_at_commit(commit_a)
-        diff_b = self._diff_at_commit(commit_b)
+        fingerprint_a = self._fingerprint_at_commit(master, commit_a)
+        fingerprint_b = self._fingerprint_at_commit(master, commit_b)
 
-        if not diff_a or not diff_b:
+        if not fingerprint_a or not fingerprint_b:
+            if fingerprint_a is not None and fingerprint_b is not None:
+                index.set_decision(master, commit_a, commit_b, False)
             return False
 
-        return diff_a == diff_b
+        identical = fingerprint_a == fingerprint_b
+        index.set_decision(master, commit_a, commit_b, identical)
+        return identical
 
-    def _calculate_reviews(self) -> Dict[str, bool]:
-        base_url = '%s/reviews' % self._base_pr_url()
-        url = base_url
+    def _reviews_url(self) -> str:
+        return '%s/reviews' % self._base_pr_url()
+
+    def _review_page_urls(self, first_response: 'requests.Response') -> List[str]:
+        # The first page of reviews tells us how many pages there are in its
+        # "last" link, which lets us request all the remaining pages at once.
+        #
+        # These links unfortunately point to GitHub, and not to the
+        # rate-limit-avoiding proxy.  Pull off the query string (ex: "?page=3")
+        # and append that to our url that goes via the proxy.
+        if 'last' not in first_response.links:
+            return []
+
+        last_url = first_response.links['last']['url']
+        github_api_path, query_string = last_url.split('?')
+        query = urllib.parse.parse_qs(query_string)
+        last_page = int(query['page'][0])
+
+        urls = []
+        for page in range(2, last_page + 1):
+            query['page'] = [str(page)]
+            urls.append('%s?%s' % (self._reviews_url(),
+                                   urllib.parse.urlencode(query, doseq=True)))
+        return urls
+
+    def _fetch_reviews(self, first_response: 'requests.Response') -> List[Tuple[str, str, str]]:
+        base_url = self._reviews_url()
 
         # List of reviews in the order they were given.
         raw_reviews: List[Tuple[str, str, str]] = []
 
-        reviews: Dict[str, bool] = {}  # username -> bool approved
-
+        page_urls = self._review_page_urls(first_response)
+        responses = [first_response] + util.request_all(page_urls)
         while True:
-            response = util.request(url)
-
-            for review in response.json():
-                user = review['user']['login']
-                if user not in self._users:
-                    continue
-                raw_reviews.append((user,
-                                    review['state'],
-                                    review['commit_id']))
-
-            if 'next' in response.links:
-                # This unfortunately points to GitHub, and not to the rate-limit-avoiding
-                # proxy.  Pull off the query string (ex: "?page=3") and append that to
-                # our url that goes via the proxy.
+            for response in responses:
+                for review in response.json():
+                    raw_reviews.append((review['user']['login'],
+                                        review['state'],
+                                        review['commit_id']))
+
+            # Without a "last" link we don't know the page count up front, and
+            # fall back to following "next" links one page at a time.
+            response = responses[-1]
+            if not page_urls and 'next' in response.links:
                 next_url = response.links['next']['url']
                 github_api_path, query_string = next_url.split('?')
-                url = '%s?%s' % (base_url, query_string)
+                responses = [util.request('%s?%s' % (base_url, query_string))]
             else:
                 break
 
+        return raw_reviews
+
+    def _calculate_reviews(self, raw_reviews: List[Tuple[str, str, str]]) -> Dict[str, bool]:
+        reviews: Dict[str, bool] = {}  # username -> bool approved
+
         for user, state, commit in reversed(raw_reviews):
             # Iterate through reviews in reverse chronological order, most recent
             # first.
 
+            if user not in self._users:
+                continue
+
             if user in reviews:
                 # Already have a judgement from this user on this PR.
                 continue
@@ -180,67 +463,78 @@ class PullRequest:
         return reviews
 
     def _base_pr_url(self, pr_number: Optional[str] = None) -> str:
-        # This is configured in nginx like:
-        #
-        # proxy_cache_path
-        #     /tmp/github-proxy
-        #     levels=1:2
-        #     keys_zone=github-proxy:1m
-        #     max_size=100m;
-        #
-        # server {
-        #   ...
-        #   location /nomic-github/repos/jeffkaufman/nomic/pulls {
-        #     if ($request_method != GET) {
-        #       return 403;
-        #     }
-        #
-        #     proxy_cache github-proxy;
-        #     proxy_ignore_headers Cache-Control Vary;
-        #     proxy_cache_valid any 1m;
-        #     proxy_pass https://api.github.com/repos/jeffkaufman/nomic/pulls;
-        #     proxy_set_header
-        #         Authorization
-        #         "Basic [base64 of 'username:token']";
-        #   }
-        #
-        # Where the token is a github personal access token:
-        #   https://github.com/settings/tokens
-        #
-        # There's an API limit of 60/hr per IP by default, and 5000/hr by
-        # user, and we need the higher limit.
-        #
-        # Responses are cached for one minute by this proxy.  The caching is
-        # optional, but now that https:/www.jefftk.com/nomic is available and
-        # world-accessible it could potentially get hit by substantial traffic.  At a
-        # 60s cache and 5k/hr limit we can have 83 GitHub API requests per page
-        # render and not go down.  As of 2018-01-18 there are eight open PRs, each
-        # of which needs a request to get reviews, so we're ok by a factor of 10.  If
-        # we have a lot of old open PRs we don't care about we could either close
-        # them or make the dashboard only gather reviews for PRs in the "reviewme"
-        # state.
         if pr_number is None:
             pr_number = self._pr_number
 
-        return 'https://www.jefftk.com/nomic-github/repos/%s/pulls/%s' % (
-            self._repo, pr_number)
+        return '%s/%s' % (pulls_url(self._repo), pr_number)
 
     def derive_pr(self, pr_number: str, target_commit: Optional[str] = None):
         # Load a different PR based on this one.  If the intended commit is not
         # specified, the PR is loaded at HEAD.
+        #
+        # Merged PRs never change, so once we've seen one we keep its details
+        # and diff on disk, and loading it again needs no requests at all.  Its
+        # reviews are only fetched if something looks at them.
+        pr_number = str(pr_number)
+        derived_fname = os.path.join(cache.cache_dir('derived', self._repo.replace('/', '-')),
+                                     '%s.json' % pr_number)
+        derived = cache.read_json(derived_fname)
+        if derived and target_commit in [None, derived['pr']['head']['sha']]:
+            cache.count('derived', 'hits')
+            target_commit = derived['pr']['head']['sha']
+            share_diff((self._repo, pr_number, target_commit), derived['diff'])
+            return PullRequest(repo=self._repo,
+                               pr_number=pr_number,
+                               target_commit=target_commit,
+                               users=self._users,
+                               pr_json=derived['pr'],
+                               prefetch_reviews=False)
+        cache.count('derived', 'misses')
+
+        pr_json = None
         if target_commit is None:
             pr_json = util.request(self._base_pr_url(pr_number)).json()
             target_commit = pr_json['head']['sha']
 
-        return PullRequest(repo=self._repo,
-                           pr_number=str(pr_number),
-                           target_commit=target_commit,
-                           users=self._users)
-
-    def diff(self) -> unidiff.PatchSet:
-        response = util.request('https://patch-diff.githubusercontent.com/raw/%s/pull/%s.diff' % (
-            self._repo, self._pr_number))
-        return unidiff.PatchSet(response.content.decode('utf-8'))
+        pr = PullRequest(repo=self._repo,
+                         pr_number=pr_number,
+                         target_commit=target_commit,
+                         users=self._users,
+                         pr_json=pr_json,
+                         prefetch_reviews=False)
+        if pr._pr_json.get('merged_at') and pr._pr_json['head']['sha'] == target_commit:
+            cache.write_json(derived_fname, {'pr': pr._pr_json, 'diff': pr._shared_diff().text})
+        return pr
+
+    def _diff_url(self) -> str:
+        return 'https://patch-diff.githubusercontent.com/raw/%s/pull/%s.diff' % (
+            self._repo, self._pr_number)
+
+    def commit_key(self) -> Tuple[str, str, str]:
+        # Which PR this is, at which commit.
+        return (self._repo, self._pr_number, self._target_commit)
+
+    def _remember_diff(self, text: str) -> SharedDiff:
+        with _shared_diffs_lock:
+            return _shared_diffs.setdefault(self.commit_key(), SharedDiff(text))
+
+    def _shared_diff(self) -> SharedDiff:
+        with _shared_diffs_lock:
+            shared_diff = _shared_diffs.get(self.commit_key())
+        if shared_diff is None:
+            shared_diff = self._remember_diff(
+                util.request(self._diff_url()).content.decode('utf-8'))
+        return shared_diff
+
+    def diff(self) -> 'unidiff.PatchSet':
+        # Parsed once and shared by everything holding this PR; rules get a
+        # PullRequestView, which copies it instead.
+        return self._shared_diff().patch_set()
+
+    def diff_summary(self) -> diffscan.DiffSummary:
+        # Which files the PR adds, modifies and removes, and how many lines,
+        # without parsing any hunks.
+        return self._shared_diff().summary()
 
     def get_new_bonuses_or_raise(self) -> List[Tuple[str, str, int]]:
         # If this PR represents adding only new bonus files, return details
@@ -249,60 +543,139 @@ class PullRequest:
         #
         # Returns [(bonus_1_user, bonus_1_name, bonus_1_value),
         #          (bonus_2_user, bonus_2_name, bonus_2_value), ... ]
+        #
+        # The diff is read a file at a time, and stops at the first file that
+        # isn't an addition, since that's the message whatever else is wrong.
+        # Plain one-line new files are checked without unidiff, and anything
+        # else is parsed with unidiff one file at a time, so the messages are
+        # the same as parsing the whole diff gives.
+        bonuses: List[Tuple[str, str, int]] = []
+        rejection: Optional[Exception] = None
 
-        diff = self.diff()
-        if diff.modified_files or diff.removed_files:
-            raise Exception('All file changes must be additions')
+        for file_diff in diffscan.file_diffs(self._shared_diff().text):
+            if diffscan.changes_existing_file(file_diff):
+                raise Exception('All file changes must be additions')
 
-        bonuses: List[Tuple[str, str, int]] = []
+            new_file = diffscan.new_one_line_file(file_diff)
+            if new_file is not None:
+                added_files = [new_file]
+            else:
+                import unidiff
+                patch_set = unidiff.PatchSet(file_diff)
+                if patch_set.modified_files or patch_set.removed_files:
+                    raise Exception('All file changes must be additions')
+                added_files = [(added_file.path, str(added_file))
+                               for added_file in patch_set.added_files]
+
+            # Keep going after a bad bonus file, in case a later file isn't an
+            # addition at all.
+            for path, text in added_files:
+                if rejection is None:
+                    try:
+                        bonuses.append(self._bonus_or_raise(path, text))
+                    except Exception as e:
+                        rejection = e
+
+        if rejection is not None:
+            raise rejection
 
-        for added_file in diff.added_files:
-            s_players, points_user, s_bonuses, bonus_name = added_file.path.split('/')
-            if s_players != 'players' or s_bonuses != 'bonuses':
-                raise Exception('Added file %s is not a bonus file' % added_file)
+        if not bonuses:
+            raise Exception('No bonus files created')
 
-            (diff_invocation_line, file_mode_line, _, removed_file_line,
-             added_file_line, patch_location_line, file_delta_line,
-             empty_line) = str(added_file).split('\n')
+        return bonuses
 
-            if diff_invocation_line != 'diff --git a/%s b/%s' % (added_file.path, added_file.path):
-                raise Exception('Unexpected diff invocation: %s' % diff_invocation_line)
+    def _bonus_or_raise(self, path: str, added_file: str) -> Tuple[str, str, int]:
+        # added_file is the file's diff, as unidiff prints it.
+        s_players, points_user, s_bonuses, bonus_name = path.split('/')
+        if s_players != 'players' or s_bonuses != 'bonuses':
+            raise Exception('Added file %s is not a bonus file' % added_file)
 
-            if file_mode_line != 'new file mode 100644':
-                raise Exception('File added with incorrect mode: %s' % file_mode_line)
+        (diff_invocation_line, file_mode_line, _, removed_file_line,
+         added_file_line, patch_location_line, file_delta_line,
+         empty_line) = added_file.split('\n')
 
-            if removed_file_line != '--- /dev/null':
-                raise Exception(
-                    'Diff format makes no sense: added files should say they are from /dev/null')
+        if diff_invocation_line != 'diff --git a/%s b/%s' % (path, path):
+            raise Exception('Unexpected diff invocation: %s' % diff_invocation_line)
 
-            if added_file_line != '+++ b/%s' % added_file.path:
-                raise Exception('Something wrong with file adding line: file is '
-                                '%s but got %s' % (added_file.path, added_file_line))
+        if file_mode_line != 'new file mode 100644':
+            raise Exception('File added with incorrect mode: %s' % file_mode_line)
 
-            if patch_location_line != '@@ -0,0 +1,1 @@':
-                raise Exception('Patch location makes no sense: %s' %
-                                patch_location_line)
+        if removed_file_line != '--- /dev/null':
+            raise Exception(
+                'Diff format makes no sense: added files should say they are from /dev/null')
 
-            if empty_line:
-                raise Exception('Last line should be empty')
+        if added_file_line != '+++ b/%s' % path:
+            raise Exception('Something wrong with file adding line: file is '
+                            '%s but got %s' % (path, added_file_line))
 
-            if file_delta_line.startswith('+'):
-                actual_file_delta = file_delta_line[1:]
-            else:
-                raise Exception('File delta missing initial + for addition: %s' %
-                                file_delta_line)
+        if patch_location_line != '@@ -0,0 +1,1 @@':
+            raise Exception('Patch location makes no sense: %s' %
+                            patch_location_line)
 
-            try:
-                points_change = int(actual_file_delta)
-            except Exception:
-                raise Exception("File should contain a single integer.")
+        if empty_line:
+            raise Exception('Last line should be empty')
 
-            bonuses.append((points_user, bonus_name, points_change))
+        if file_delta_line.startswith('+'):
+            actual_file_delta = file_delta_line[1:]
+        else:
+            raise Exception('File delta missing initial + for addition: %s' %
+                            file_delta_line)
 
-        if not bonuses:
-            raise Exception('No bonus files created')
+        try:
+            points_change = int(actual_file_delta)
+        except Exception:
+            raise Exception("File should contain a single integer.")
 
-        return bonuses
+        return points_user, bonus_name, points_change
 
     def author(self) -> str:
         return self._pr_json['user']['login']
+
+
+class PullRequestView:
+    # What each rule gets instead of a deep copy of the PullRequest.  Reads go
+    # through to the PR, but anything a rule changes stays on its view: setting
+    # an attribute stores it here, and list or dict attributes are copied the
+    # first time a rule touches them.  Methods run against the view, so they
+    # see those changes and read the same copies, the parsed diff is copied
+    # for the view the first time it's asked for, and PRs a method returns
+    # come back as views too.  So a misbehaving rule still can't change what
+    # later rules see, and making a view costs the same however big the PR
+    # is.
+    def __init__(self, pr: PullRequest):
+        object.__setattr__(self, '_view_pr', pr)
+        object.__setattr__(self, '_view_overrides', {})
+
+    def __getattr__(self, name: str):
+        overrides = self._view_overrides
+        if name not in overrides:
+            value = getattr(self._view_pr, name)
+            if isinstance(value, types.MethodType) and value.__self__ is self._view_pr:
+                return self._view_method(value.__func__)
+            if not isinstance(value, (list, dict, set)):
+                return value
+            overrides[name] = copy.deepcopy(value)
+        return overrides[name]
+
+    def _view_method(self, fn) -> types.MethodType:
+        # Bound to this view, so a view of this view binds it to itself in
+        # turn.
+        def method(view, *args, **kwargs):
+            result = fn(view, *args, **kwargs)
+            if isinstance(result, PullRequest):
+                return PullRequestView(result)
+            return result
+        return types.MethodType(method, self)
+
+    def _shared_diff(self) -> SharedDiff:
+        # This view's own copy of the diff, parsed or summarized by copying
+        # the PR's.
+        if '_shared_diff' not in self._view_overrides:
+            self._view_overrides['_shared_diff'] = self._view_pr._shared_diff().copy()
+        return self._view_overrides['_shared_diff']
+
+    def __setattr__(self, name: str, value) -> None:
+        self._view_overrides[name] = value
+
+    def __delattr__(self, name: str) -> None:
+        self._view_overrides.pop(name, None)
@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Mapping, Optional
+
+import cache
+
+if TYPE_CHECKING:
+    import requests
+
+# Keeps track of how much of the GitHub API budget (5000/hr for the proxy's
+# token) is left, as reported in the X-RateLimit-* headers, and shares that
+# with other runs on this machine through the cache directory.  Dashboard
+# refreshes leave a reserve for merge validations, and slow down as the budget
+# runs low, so that builds keep working.  Secondary rate limits and server
+# errors are retried with backoff.
+
+# Lower numbers go first.
+PRIORITY_MERGE = 0
+PRIORITY_DASHBOARD = 1
+PRIORITIES = {'merge': PRIORITY_MERGE, 'dashboard': PRIORITY_DASHBOARD}
+
+# How much budget each priority has to leave for the ones above it.
+RESERVE = {
+    PRIORITY_MERGE: 0,
+    PRIORITY_DASHBOARD: 500,
+}
+
+# Below this many requests left, requests at lower than merge priority are
+# spaced out to make what's left last until the reset.
+SPACING_THRESHOLD = 1000
+
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 1.0
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class RateLimitExhausted(Exception):
+    pass
+
+
+def _int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def _describe_reset(reset: float) -> str:
+    return '%s (in %s minutes)' % (
+        time.strftime('%H:%M:%S', time.localtime(reset)), max(0, int((reset - time.time()) / 60) + 1))
+
+
+class Budget:
+    def __init__(self) -> None:
+        self._path = os.path.join(cache.cache_dir('ratelimit'), 'budget.json')
+        self._lock = threading.Lock()
+        self._next_request = 0.0
+
+    def _load(self) -> Dict[str, int]:
+        return cache.read_json(self._path, default={})
+
+    def remaining(self) -> Optional[int]:
+        # None if we don't know, and the whole limit once the window resets.
+        state = self._load()
+        if 'remaining' not in state:
+            return None
+        if state['reset'] <= time.time():
+            return state['limit']
+        return state['remaining']
+
+    def observe(self, headers: Mapping[str, str]) -> None:
+        remaining = _int_header(headers, 'X-RateLimit-Remaining')
+        reset = _int_header(headers, 'X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        limit = _int_header(headers, 'X-RateLimit-Limit') or 5000
+        cache.write_json(self._path, {'limit': limit, 'remaining': remaining, 'reset': reset})
+
+    def check(self, requests_needed: int, priority: int) -> None:
+        # Raise now, before doing any work, if we know the budget can't cover
+        # what we're about to do.
+        state = self._load()
+        remaining = self.remaining()
+        if remaining is None:
+            return
+        available = remaining - RESERVE[priority]
+        if available < requests_needed:
+            raise RateLimitExhausted(
+                'GitHub API budget too low: %s requests left (%s held back for higher priority work),'
+                ' need about %s.  It resets at %s.' % (
+                    remaining, RESERVE[priority], requests_needed, _describe_reset(state['reset'])))
+
+    def wait_turn(self, priority: int) -> None:
+        if priority == PRIORITY_MERGE:
+            return
+
+        state = self._load()
+        remaining = self.remaining()
+        if remaining is None or remaining >= SPACING_THRESHOLD:
+            return
+        self.check(1, priority)
+
+        # Spread what we're allowed to use evenly over the rest of the window.
+        interval = (state['reset'] - time.time()) / max(1, remaining - RESERVE[priority])
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_request)
+            self._next_request = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+    def retry_delay(self, response: 'requests.Response', attempt: int) -> Optional[float]:
+        # How long to wait before trying again, or None if we shouldn't.
+        if response.status_code == 403 and _int_header(response.headers, 'X-RateLimit-Remaining') == 0:
+            reset = _int_header(response.headers, 'X-RateLimit-Reset') or time.time()
+            raise RateLimitExhausted('GitHub API budget exhausted.  It resets at %s.' % _describe_reset(reset))
+
+        secondary = response.status_code == 403 and (
+            'Retry-After' in response.headers or b'secondary rate limit' in response.content.lower())
+        if not secondary and response.status_code not in RETRY_STATUSES:
+            return None
+        if attempt >= MAX_RETRIES:
+            return None
+
+        retry_after = _int_header(response.headers, 'Retry-After')
+        if retry_after is not None:
+            return float(retry_after)
+        return BACKOFF_SECONDS * 2 ** attempt
+
+
+_budget: Optional[Budget] = None
+_budget_lock = threading.Lock()
+
+
+def budget() -> Budget:
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = Budget()
+        return _budget
+
+
+def _priority_from_environment() -> int:
+    # A typo here shouldn't stop validate.py, so it falls back to the default
+    # that validations use.
+    name = os.environ.get('NOMIC_REQUEST_PRIORITY', 'merge')
+    if name not in PRIORITIES:
+        print('Ignoring NOMIC_REQUEST_PRIORITY=%s: expected one of %s; using merge' % (
+            name, ', '.join(sorted(PRIORITIES))))
+        return PRIORITY_MERGE
+    return PRIORITIES[name]
+
+
+_priority = _priority_from_environment()
+
+
+def priority() -> int:
+    return _priority
+
+
+def set_priority(new_priority: int) -> None:
+    # Everything this process requests from now on is at new_priority.
+    global _priority
+    _priority = new_priority
+
+
+def check(requests_needed: int) -> None:
+    budget().check(requests_needed, priority())
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import subprocess
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import cache
+
+if TYPE_CHECKING:
+    import requests
+    import replay_server
+
+# Set NOMIC_RECORD to a directory to save every HTTP response and every git
+# fetch there as it happens.  Set NOMIC_REPLAY to such a directory to run
+# against the recording instead of the network: HTTP requests go to a stand-in
+# server on localhost that answers from the recording (see replay_server.py),
+# and git fetches come from the recorded repositories.  synthetic.py writes
+# recordings too.
+#
+# A recording looks like:
+#
+#   http/<sha256 of url>.json  url and response headers
+#   http/<sha256 of url>.body  response body
+#   git/<sha256 of url>.git    a repository with the refs we fetched from url
+RECORD_ENV = 'NOMIC_RECORD'
+REPLAY_ENV = 'NOMIC_REPLAY'
+
+# Everything else about a response is either irrelevant to us or describes
+# the connection it came over.
+RECORDED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified', 'Link', 'X-RateLimit-Limit',
+                    'X-RateLimit-Remaining', 'X-RateLimit-Reset']
+
+
+def recording_dir() -> Optional[str]:
+    return os.environ.get(RECORD_ENV)
+
+
+def replay_dir() -> Optional[str]:
+    return os.environ.get(REPLAY_ENV)
+
+
+def _key(url: str) -> str:
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def _http_paths(fixture_dir: str, url: str) -> Tuple[str, str]:
+    # (metadata, body)
+    base = os.path.join(fixture_dir, 'http', _key(url))
+    return base + '.json', base + '.body'
+
+
+def git_fixture_path(fixture_dir: str, url: str) -> str:
+    return os.path.join(fixture_dir, 'git', '%s.git' % _key(url))
+
+
+def write_response(fixture_dir: str, url: str, headers: Dict[str, str], body: bytes) -> None:
+    meta_path, body_path = _http_paths(fixture_dir, url)
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    cache.write_atomic(body_path, body)
+    cache.write_json(meta_path, {
+        'url': url,
+        'headers': {name: headers[name] for name in RECORDED_HEADERS if name in headers},
+    })
+
+
+def read_response(fixture_dir: str, url: str) -> Optional[Tuple[Dict[str, str], bytes]]:
+    meta_path, body_path = _http_paths(fixture_dir, url)
+    meta = cache.read_json(meta_path)
+    if meta is None or meta.get('url') != url:
+        return None
+    with open(body_path, 'rb') as inf:
+        return meta['headers'], inf.read()
+
+
+def record_response(url: str, response: 'requests.Response') -> None:
+    fixture_dir = recording_dir()
+    if fixture_dir:
+        write_response(fixture_dir, url, dict(response.headers), response.content)
+
+
+def record_fetch(git_dir: str, url: str, refspecs: List[str]) -> None:
+    # After fetching from url into git_dir, copy what we fetched into the
+    # recording under the names it had on the remote.  refspecs are
+    # "local:remote".
+    fixture_dir = recording_dir()
+    if not fixture_dir:
+        return
+    fixture_repo = git_fixture_path(fixture_dir, url)
+    if not os.path.exists(fixture_repo):
+        subprocess.check_call(['git', 'init', '--bare', '--quiet', fixture_repo])
+    subprocess.check_call(['git', '--git-dir', git_dir, 'push', '--quiet', '--force',
+                           fixture_repo] + refspecs)
+
+
+def git_url(url: str) -> str:
+    # Where to fetch url from: the recording when replaying, otherwise url.
+    fixture_dir = replay_dir()
+    if not fixture_dir:
+        return url
+    fixture_repo = git_fixture_path(fixture_dir, url)
+    if not os.path.exists(fixture_repo):
+        raise Exception('No recorded git repository for %s in %s' % (url, fixture_dir))
+    return fixture_repo
+
+
+_server: Optional['replay_server.StandInServer'] = None
+_server_lock = threading.Lock()
+
+
+def request_url(url: str) -> str:
+    # Where to send a request for url: the stand-in server when replaying,
+    # otherwise url itself.
+    global _server
+    fixture_dir = replay_dir()
+    if not fixture_dir:
+        return url
+    with _server_lock:
+        if _server is None:
+            # Only replaying needs the HTTP server modules, so don't pay for
+            # importing them otherwise.
+            import replay_server
+            _server = replay_server.StandInServer(fixture_dir)
+        return _server.url_for(url)
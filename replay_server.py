@@ -0,0 +1,60 @@
+import http.server
+import socketserver
+import threading
+import urllib.parse
+
+import replay
+
+# The stand-in server that answers HTTP requests from a recording when
+# replaying.  See replay.py.
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Paths are "/" plus the quoted original URL.
+    fixture_dir = ''
+
+    def do_GET(self) -> None:
+        url = urllib.parse.unquote(self.path[1:])
+        recorded = replay.read_response(self.fixture_dir, url)
+        if recorded is None:
+            self.send_error(404, 'Nothing recorded for %s' % url)
+            return
+        headers, body = recorded
+
+        if 'ETag' in headers and self.headers.get('If-None-Match') == headers['ETag']:
+            self.send_response(304)
+            self.send_header('ETag', headers['ETag'])
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer:
+    # Answers HTTP requests from a recording, on a free port on localhost, from
+    # a background thread.
+    def __init__(self, fixture_dir: str):
+        handler = type('Handler', (_Handler,), {'fixture_dir': fixture_dir})
+        self._server = _ThreadingServer(('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:%s' % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def url_for(self, url: str) -> str:
+        return '%s/%s' % (self.url, urllib.parse.quote(url, safe=''))
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,99 @@
+import builtins
+import hashlib
+import marshal
+import os
+import sys
+import threading
+from types import CodeType
+from typing import Any, Callable, Dict, Tuple
+
+import cache
+
+# rule path -> (sha256 of source, compiled code)
+_compiled: Dict[str, Tuple[str, CodeType]] = {}
+_compiled_lock = threading.Lock()
+
+
+def _compile(rule_fname: str, source: bytes, digest: str) -> CodeType:
+    # Compiled rules are also kept on disk, keyed by the hash of their source,
+    # so a new process doesn't need to compile them again either.
+    pyc_fname = os.path.join(cache.cache_dir('rules'), '%s.%s.marshal' % (
+        digest, sys.implementation.cache_tag))
+    try:
+        with open(pyc_fname, 'rb') as inf:
+            code = marshal.load(inf)
+        if isinstance(code, CodeType) and code.co_filename == rule_fname:
+            return code
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    code = compile(source, rule_fname, 'exec', dont_inherit=True)
+    cache.write_atomic(pyc_fname, marshal.dumps(code))
+    return code
+
+
+def compiled_rule(rule_fname: str) -> CodeType:
+    # The rule file is hashed every time, so editing a rule always takes
+    # effect, but it's only compiled when the hash changes.
+    with open(rule_fname, 'rb') as inf:
+        source = inf.read()
+    digest = hashlib.sha256(source).hexdigest()
+
+    with _compiled_lock:
+        cached = _compiled.get(rule_fname)
+        if cached and cached[0] == digest:
+            return cached[1]
+
+        code = _compile(rule_fname, source, digest)
+        _compiled[rule_fname] = (digest, code)
+        return code
+
+
+def rule_digest(rule_fname: str) -> str:
+    # The sha256 of the rule's current source.
+    compiled_rule(rule_fname)
+    with _compiled_lock:
+        return _compiled[rule_fname][0]
+
+
+def run_rule(rule_fname: str) -> Dict[str, Any]:
+    # Like runpy.run_path: run the rule file as a fresh module and return its
+    # globals.
+    namespace: Dict[str, Any] = {
+        '__name__': '<run_path>',
+        '__file__': rule_fname,
+        '__cached__': None,
+        '__doc__': None,
+        '__loader__': None,
+        '__package__': '',
+        '__spec__': None,
+        '__builtins__': builtins,
+    }
+    exec(compiled_rule(rule_fname), namespace)
+    return namespace
+
+
+def takes_state(fn: Callable) -> bool:
+    # Rules are written as should_allow(pr) or should_block(pr), or with the
+    # GameState as a second argument to save working it out again.
+    import inspect
+    try:
+        parameters = inspect.signature(fn).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    positional = [parameter for parameter in parameters
+                  if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD,
+                                        parameter.VAR_POSITIONAL)]
+    return len(positional) > 1 or any(parameter.kind == parameter.VAR_POSITIONAL for parameter in positional)
+
+
+def call_rule(fn: Callable, pr, state=None) -> Any:
+    # Rules that take the state always get one from here, the caller's or a
+    # fresh snapshot, even though they still fall back to their own snapshot
+    # when called directly as should_allow(pr).
+    if takes_state(fn):
+        if state is None:
+            import game_state
+            state = game_state.snapshot()
+        return fn(pr, state)
+    return fn(pr)
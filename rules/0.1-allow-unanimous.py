@@ -1,7 +1,11 @@
-import util
+import game_state
 
+PURE = True
 
-def should_allow(pr):
-    if not all(user in pr.approvals for user in util.users()):
+
+def should_allow(pr, state=None):
+    if state is None:
+        state = game_state.snapshot()
+    if not state.players <= pr.approval_set:
         raise Exception('PR does not have unanimous approval')
     return True
@@ -1,8 +1,106 @@
+import hashlib
+import os
+import time
 import pycodestyle
+import cache
+
+MAX_LINE_LENGTH = 120
+
+# Working directories other tools leave behind, which aren't part of the tree.
+EXCLUDE = pycodestyle.DEFAULT_EXCLUDE.split(',') + ['tmp-repo', 'tmp-nomic-master']
+
+# Results are cached per file by content hash, and the key includes everything
+# that could change what the checker says about the same content.
+CONFIG_KEY = 'pycodestyle=%s max_line_length=%s exclude=%s' % (
+    pycodestyle.__version__, MAX_LINE_LENGTH, ','.join(EXCLUDE))
+
+MAX_CACHED_FILES = 5000
+
+
+class CollectingReport(pycodestyle.BaseReport):
+    # Keeps each error instead of printing it, so results can be cached.
+    def __init__(self, options):
+        super().__init__(options)
+        self.errors = []
+
+    def error(self, line_number, offset, text, check):
+        code = super().error(line_number, offset, text, check)
+        if code:
+            self.errors.append((line_number, offset, text))
+        return code
+
+    def error_lines(self):
+        # Formatted and ordered like pycodestyle's default report.
+        return ['%s:%d:%d: %s' % (self.filename, line_number, offset + 1, text)
+                for line_number, offset, text in sorted(self.errors)]
+
+
+def files_to_check(style, pr):
+    # With NOMIC_PEP8_CHANGED_ONLY=1 only look at files the PR adds or
+    # modifies; otherwise the whole tree, walked the way check_files('.') does.
+    if os.environ.get('NOMIC_PEP8_CHANGED_ONLY'):
+        summary = pr.diff_summary()
+        return [path for path in summary.added + summary.modified
+                if pycodestyle.filename_match(os.path.basename(path), style.options.filename)
+                and not style.excluded(path) and os.path.exists(path)]
+
+    paths = []
+    for root, dirs, files in os.walk('.'):
+        for subdir in sorted(dirs):
+            if style.excluded(subdir, root):
+                dirs.remove(subdir)
+        for filename in sorted(files):
+            if (pycodestyle.filename_match(filename, style.options.filename) and
+                    not style.excluded(filename, root)):
+                paths.append(os.path.join(root, filename))
+    return paths
 
 
 def should_block(pr):
-    style = pycodestyle.StyleGuide(max_line_length=120)
-    result = style.check_files('.')
-    if result.total_errors > 0:
+    style = pycodestyle.StyleGuide(max_line_length=MAX_LINE_LENGTH, exclude=EXCLUDE,
+                                   reporter=CollectingReport)
+    report = style.options.report
+
+    results_fname = os.path.join(cache.cache_dir('pep8'), 'results.json')
+    results = cache.read_json(results_fname, default={})
+    used = {}
+
+    total_errors = 0
+    print('pep8 timings:')
+    for path in files_to_check(style, pr):
+        start = time.time()
+        with open(path, 'rb') as inf:
+            key = hashlib.sha256(CONFIG_KEY.encode('utf-8') + b'\0' + inf.read()).hexdigest()
+
+        if key in results:
+            cache.count('pep8', 'hits')
+            file_errors, lines = results[key]['errors'], results[key]['lines']
+            lines = [line.replace(results[key]['path'], path, 1) for line in lines]
+            source = 'cached'
+        else:
+            cache.count('pep8', 'misses')
+            report.errors = []
+            file_errors = style.input_file(path)
+            lines = report.error_lines()
+            source = 'checked'
+
+        used[key] = {'errors': file_errors, 'lines': lines, 'path': path, 'used': int(time.time())}
+
+        print('  %.3fs %s %s' % (time.time() - start, source, path))
+        for line in lines:
+            print(line)
+        total_errors += file_errors
+
+    if used:
+        # Other builds may have saved results since we read them, so merge
+        # into what's there now, with no one else writing in between.
+        with cache.locked(results_fname):
+            results = cache.read_json(results_fname, default={})
+            results.update(used)
+            recent = sorted(results, key=lambda key: results[key]['used'])
+            for key in recent[:-MAX_CACHED_FILES]:
+                del results[key]
+            cache.write_json(results_fname, results)
+
+    if total_errors > 0:
         raise Exception('pep8 check failed')
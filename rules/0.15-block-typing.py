@@ -1,13 +1,60 @@
 import os
 import copy
+import hashlib
+import shutil
 import subprocess
+import sys
+import cache
+import tracing
 
 
-def should_block(pr):
-    cmd = ['mypy', 'validate.py']
+def mypy_cache_dir():
+    # mypy's cache survives between runs, so only modules that changed are
+    # checked again.  It records absolute paths, so each checkout gets its own.
+    checkout = hashlib.sha256(os.path.abspath('.').encode('utf-8')).hexdigest()[:16]
+    return cache.cache_dir('mypy', checkout)
+
+
+def run_mypy(cache_dir):
+    # --verbose makes mypy log, for each module, whether it could reuse what's
+    # in the cache ("Metadata fresh for ...") or not.
+    cmd = ['mypy', '--verbose', '--cache-dir', cache_dir, 'validate.py']
     env = copy.copy(os.environ)
     env['MYPYPATH'] = 'stubs'
-    completed_process = subprocess.run(cmd, stdout=subprocess.PIPE, env=env)
+    with tracing.span('subprocess', 'mypy') as span:
+        completed_process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        span['returncode'] = completed_process.returncode
+
+    modules = 0
+    fresh_modules = 0
+    for line in completed_process.stderr.decode('utf-8', 'replace').split('\n'):
+        if line.startswith('LOG:  Metadata '):
+            modules += 1
+            if line.startswith('LOG:  Metadata fresh '):
+                fresh_modules += 1
+        elif not line.startswith('LOG: ') and line:
+            sys.stderr.write(line + '\n')
+
+    return completed_process, modules, fresh_modules
+
+
+def should_block(pr):
+    cache_dir = mypy_cache_dir()
+    # mypy doesn't expect anyone else to be writing its cache, so only one
+    # build at a time gets to use (or throw away) this one.
+    with cache.locked(cache_dir):
+        completed_process, modules, fresh_modules = run_mypy(cache_dir)
+
+        if completed_process.returncode not in [0, 1]:
+            # 1 means type errors; anything else means mypy itself fell over,
+            # which can happen with a corrupt cache.  Throw the cache away and
+            # try again cold.
+            print(completed_process.stdout.decode('utf-8'))
+            print('mypy failed with a warm cache; retrying without it')
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            completed_process, modules, fresh_modules = run_mypy(mypy_cache_dir())
+
     print(completed_process.stdout.decode('utf-8'))
+    print('mypy: %s of %s modules served from cache' % (fresh_modules, modules))
     if completed_process.returncode != 0:
         raise Exception('mypy failed')
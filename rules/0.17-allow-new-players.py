@@ -1,10 +1,14 @@
-import util
+import game_state
+
+PURE = True
 
 # This value set to 0 until we figure out a good way to prevent dummy account abuse
 max_start_bonus = 0
 
 
-def should_allow(pr):
+def should_allow(pr, state=None):
+    if state is None:
+        state = game_state.snapshot()
     bonuses = pr.get_new_bonuses_or_raise()
 
     if len(bonuses) > 1:
@@ -14,7 +18,7 @@ def should_allow(pr):
 
     (points_user, points_name, points_change) = bonuses[0]
 
-    if points_user in util.users():
+    if state.is_player(points_user):
         raise Exception('Cannot create an existing user')
 
     if points_name != 'initial':
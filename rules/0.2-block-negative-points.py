@@ -1,8 +1,12 @@
-import util
+import game_state
 
+PURE = True
 
-def should_block(pr):
-    for user, user_points in util.get_user_points().items():
-        if util.total_user_points(user_points) < 0:
+
+def should_block(pr, state=None):
+    if state is None:
+        state = game_state.snapshot()
+    for user, user_points in state.user_points.items():
+        if state.total_points[user] < 0:
             raise Exception('Would bring user %s points to %s which is negative.' %
-                            (user, user_points))
+                            (user, dict(user_points)))
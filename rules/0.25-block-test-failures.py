@@ -1,5 +1,5 @@
 import os
-import runpy
+import rule_loader
 
 SIMPLE_TESTS = {
     '0.3-allow-points-transfer.py': [
@@ -10,16 +10,17 @@ SIMPLE_TESTS = {
 }
 
 
-def run_test(pr_number, derived_pr, rule_fname, expected_result):
+def run_test(pr_number, derived_pr, rule_fname, expected_result, state=None):
     _, allow_block, _ = rule_fname.split('-', 2)
     fn_name = 'should_allow' if (allow_block == 'allow') else 'should_block'
     print('TEST %s:%s(%s)' % (rule_fname, fn_name, pr_number))
 
-    rule_py = runpy.run_path(os.path.join('rules/', rule_fname))
+    # The rule next to this one, wherever this one is.
+    rule_py = rule_loader.run_rule(os.path.join(os.path.dirname(__file__), rule_fname))
     fn = rule_py[fn_name]
 
     try:
-        fn(derived_pr)
+        rule_loader.call_rule(fn, derived_pr, state)
     except Exception as e:
         if str(e) != expected_result:
             raise Exception('expected "%s" got "%s"' % (expected_result, e))
@@ -29,7 +30,7 @@ def run_test(pr_number, derived_pr, rule_fname, expected_result):
         raise Exception('expected "%s" but no error was raised')
 
 
-def should_block(pr):
+def should_block(pr, state=None):
     # run tests, raise an exception if any fail
 
     # Cache calls to derive_pr because they're expensive.
@@ -41,4 +42,4 @@ def should_block(pr):
                 derived_prs[pr_number] = pr.derive_pr(pr_number)
             derived_pr = derived_prs[pr_number]
 
-            run_test(pr_number, derived_pr, rule_fname, expected_result)
+            run_test(pr_number, derived_pr, rule_fname, expected_result, state)
@@ -1,7 +1,9 @@
-import util
+import game_state
 
+PURE = True
 
-def should_allow(pr):
+
+def should_allow(pr, state=None):
     # If a PR only moves points around by the creation of new bonus files, has
     # been approved by every player losing points, reduces the total number of
     # points, and does not create any new users, allow it.
@@ -18,16 +20,18 @@ def should_allow(pr):
     #  - me:  -1 point
     #  - you: +1 point
 
+    if state is None:
+        state = game_state.snapshot()
     bonuses = pr.get_new_bonuses_or_raise()
 
     total_points_change = 0
     for points_user, points_name, points_change in bonuses:
-        if points_user not in util.users():
+        if not state.is_player(points_user):
             raise Exception('Points transfer PRs should not add users: got %s' %
                             points_user)
 
         if points_change < 0:
-            if points_user not in pr.approvals:
+            if points_user not in pr.approval_set:
                 raise Exception('Taking %s points from %s requires their approval.' % (
                     abs(points_change), points_user))
 
@@ -1,7 +1,11 @@
-import util
+import game_state
 
+PURE = True
 
-def should_block(pr):
+
+def should_block(pr, state=None):
+    if state is None:
+        state = game_state.snapshot()
     # Don't allow PRs to be merged the day they're created unless they pass unanimously
-    if len(pr.approvals) < len(util.users()) and (pr.days_since_created() < 1):
+    if len(pr.approvals) < len(state.users) and (pr.days_since_created() < 1):
         raise Exception('PR created within last 24 hours does not have unanimous approval.')
@@ -0,0 +1,46 @@
+import argparse
+import os
+import sys
+
+import pull_request
+import util
+import validate
+
+# What run.sh runs: validate.py set up the way Travis does, in this same
+# process.  Looking up a PR's head commit goes through util.request, so it
+# uses the HTTP cache and the rate-limit budget, and works when replaying.
+
+REPO = 'jeffkaufman/nomic'
+
+
+def head_sha(repo: str, pr_number: str) -> str:
+    return util.request('%s/%s' % (pull_request.pulls_url(repo), pr_number)).json()['head']['sha']
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Run validate.py the way Travis does.')
+    parser.add_argument('--two-phase', action='store_true',
+                        help='validate by the rules on master, then by the rules checked out here')
+    parser.add_argument('pr', nargs='?',
+                        help='PR to check; without one, check whether someone has won')
+    parser.add_argument('commit', nargs='?', help="commit to check the PR at (default: the PR's head)")
+    args = parser.parse_args()
+
+    os.environ['TRAVIS_REPO_SLUG'] = REPO
+    if args.pr is None:
+        os.environ['TRAVIS_PULL_REQUEST'] = 'false'
+    else:
+        os.environ['TRAVIS_PULL_REQUEST'] = args.pr
+        os.environ['TRAVIS_PULL_REQUEST_SHA'] = args.commit or head_sha(REPO, args.pr)
+
+    for variable in ['TRAVIS_REPO_SLUG', 'TRAVIS_PULL_REQUEST', 'TRAVIS_PULL_REQUEST_SHA']:
+        print("%s='%s'" % (variable, os.environ.get(variable, '')))
+    print()
+    print('validate.py:')
+
+    sys.argv = ['validate.py', 'two-phase' if args.two_phase else 'master']
+    validate.start()
+
+
+if __name__ == '__main__':
+    start()
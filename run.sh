@@ -1,11 +1,11 @@
 #!/bin/bash
 #
 # Runs validate.py, setting things up the way Travis does.  Allows you to see
-# the effects of changes.
+# the effects of changes.  See run.py.
 #
 # Usage:
 #
-#   ./run.sh [pr number] [commit sha]
+#   ./run.sh [--two-phase] [pr number] [commit sha]
 #
 # For example:
 #
@@ -18,25 +18,9 @@
 #   ./run.sh 33 ad567cd49e1c450
 #     Same, but as of commit ad567cd49e1c450
 #
+#   ./run.sh --two-phase 33
+#     Like Travis, validate #33 by the rules on master and then by the rules
+#     checked out here, in one process.
+#
 
-export TRAVIS_REPO_SLUG="jeffkaufman/nomic"
-API_URL="https://www.jefftk.com/nomic-github/repos/$TRAVIS_REPO_SLUG"
-
-if [ $# -eq 0 ]; then
-  export TRAVIS_PULL_REQUEST="false"
-else
-  export TRAVIS_PULL_REQUEST="$1"
-
-  if [ $# -gt 1 ]; then
-    export TRAVIS_PULL_REQUEST_SHA="$2"
-  else
-    export TRAVIS_PULL_REQUEST_SHA=$(curl -sS "$API_URL/pulls/$TRAVIS_PULL_REQUEST" | python3 -c "import sys, json; print(json.load(sys.stdin)['head']['sha'])")
-  fi
-fi
-
-echo "TRAVIS_REPO_SLUG='$TRAVIS_REPO_SLUG'"
-echo "TRAVIS_PULL_REQUEST='$TRAVIS_PULL_REQUEST'"
-echo "TRAVIS_PULL_REQUEST_SHA='$TRAVIS_PULL_REQUEST_SHA'"
-echo
-echo "validate.py:"
-python3 validate.py master
+exec python3 "$(dirname "$0")/run.py" "$@"
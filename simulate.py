@@ -0,0 +1,214 @@
+import argparse
+import bisect
+import itertools
+import random
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import numpy  # type: ignore
+except ImportError:
+    numpy = None
+
+import util
+import winner
+
+# How long is the game likely to go on, and who is likely to win it, if it
+# continues from the current points?
+#
+# After every merge to master, determine_if_winner draws a number from the
+# merge commit's hash, and someone wins if it lands inside the players'
+# ranges on the number line.  Each merge also gives its author a point.  As
+# long as no one has negative points, that means after k more merges there
+# are always total + k points on the line whoever made them, so the chance
+# that the game ends at merge k doesn't depend on who merged.  That gives the
+# distribution of game lengths exactly, and the chance of each player winning
+# is then their expected share of the line when it ends: their own points
+# plus their expected share of the k new merges.
+#
+# The simulator doesn't lean on any of that, so it can catch a mistake in it:
+# it plays each game merge by merge, giving the point to an author drawn by
+# weight, drawing a number the way util.random() gives one from a merge hash,
+# and asking winner.WinnerTable on the updated points who, if anyone, won.
+# With numpy it plays a batch of games side by side.
+
+DEFAULT_SAMPLES = 100000
+# How many points (players times games) to keep at once when playing a batch
+# of games with numpy.
+MAX_BATCH_POINTS = 10000000
+PERCENTILES = [10, 25, 50, 75, 90, 99]
+
+# Past this point the chance the game is still going is negligible.
+MIN_SURVIVAL = 1e-12
+
+
+class Forecast(NamedTuple):
+    # length_pmf[k - 1] is the chance the game ends with the kth merge from
+    # now.
+    length_pmf: List[float]
+    win_probabilities: Dict[str, float]
+
+
+def merge_weights(all_user_points: Dict[str, Dict[str, int]], authors: str) -> List[float]:
+    # How likely each player is to author the next merge.
+    users = list(all_user_points)
+    if authors == 'history':
+        merges = [all_user_points[user].get('merge', 0) for user in users]
+        if sum(merges) > 0:
+            return [merge / sum(merges) for merge in merges]
+    return [1.0 / len(users)] * len(users)
+
+
+def length_pmf(total_points: int) -> List[float]:
+    pmf = []
+    survival = 1.0
+    for k in itertools.count(1):
+        points = total_points + k
+        win_chance = min(1.0, winner.scalar(points) * points)
+        pmf.append(survival * win_chance)
+        survival *= 1 - win_chance
+        if survival < MIN_SURVIVAL:
+            return pmf
+    raise Exception('unreachable')
+
+
+def forecast(summed_user_points: List[Tuple[str, int]], weights: List[float]) -> Forecast:
+    if any(user_points < 0 for _, user_points in summed_user_points):
+        raise Exception('Forecasting assumes no one has negative points')
+    total_points = sum(user_points for _, user_points in summed_user_points)
+    pmf = length_pmf(total_points)
+
+    # sum over k of P(ends at k) * (points + k * weight) / (total + k)
+    from_points = sum(p / (total_points + k) for k, p in enumerate(pmf, 1))
+    from_merges = sum(p * k / (total_points + k) for k, p in enumerate(pmf, 1))
+    return Forecast(length_pmf=pmf, win_probabilities={
+        user: user_points * from_points + weight * from_merges
+        for (user, user_points), weight in zip(summed_user_points, weights)})
+
+
+def _cumulative(values: List[float]) -> List[float]:
+    return list(itertools.accumulate(values))
+
+
+def _winner_index(users: List[str], points: List[int], rnd: float) -> Optional[int]:
+    won = winner.WinnerTable(list(zip(users, points))).winner(rnd)
+    if won is None:
+        return None
+    return users.index(won)
+
+
+def sample(summed_user_points: List[Tuple[str, int]], weights: List[float],
+           samples: int, seed: Optional[int]) -> Tuple[List[int], List[int]]:
+    # Returns (game lengths, wins per player), for `samples` games.
+    users = [user for user, _ in summed_user_points]
+    start_points = [user_points for _, user_points in summed_user_points]
+    weights_cdf = _cumulative(weights)
+    game_lengths: List[int] = []
+    wins = [0] * len(users)
+
+    if numpy is not None:
+        generator = numpy.random.default_rng(seed)
+        # Each game in a batch keeps everyone's points, so the batches are
+        # only as big as fits in memory.
+        batch_size = max(1, MAX_BATCH_POINTS // len(users))
+        for batch_start in range(0, samples, batch_size):
+            points = numpy.tile(numpy.array(start_points, dtype=numpy.int64),
+                                (min(batch_size, samples - batch_start), 1))
+            positive_totals = numpy.maximum(points, 0).sum(axis=1)
+            playing = numpy.arange(len(points))
+            length = 0
+            while len(playing):
+                length += 1
+                authors = numpy.minimum(numpy.searchsorted(
+                    weights_cdf, generator.random(len(playing)) * weights_cdf[-1], side='right'), len(users) - 1)
+                points[playing, authors] += 1
+                positive_totals[playing] += points[playing, authors] > 0
+                rnd = generator.random(len(playing))
+                # winner.scalar(total) * total for every game at once; only the
+                # games whose number landed below it can have a winner.
+                totals = positive_totals[playing]
+                line_ends = numpy.minimum(1.0 / winner.LINE_LENGTH, 1.0 / numpy.maximum(totals, 1)) * totals
+                finished = numpy.zeros(len(playing), dtype=bool)
+                for i in numpy.nonzero(rnd < line_ends)[0]:
+                    won = _winner_index(users, points[playing[i]].tolist(), float(rnd[i]))
+                    if won is not None:
+                        game_lengths.append(length)
+                        wins[won] += 1
+                        finished[i] = True
+                playing = playing[~finished]
+        return game_lengths, wins
+
+    rng = random.Random(seed)
+    for _ in range(samples):
+        points = list(start_points)
+        positive_total = sum(user_points for user_points in points if user_points > 0)
+        for length in itertools.count(1):
+            author = min(bisect.bisect_right(weights_cdf, rng.random() * weights_cdf[-1]), len(users) - 1)
+            points[author] += 1
+            if points[author] > 0:
+                positive_total += 1
+            rnd = rng.random()
+            # No one's range reaches past the positive points, so only then
+            # is there anyone to look up.
+            if positive_total > 0 and rnd < winner.scalar(positive_total) * positive_total:
+                won = _winner_index(users, points, rnd)
+                if won is not None:
+                    game_lengths.append(length)
+                    wins[won] += 1
+                    break
+    return game_lengths, wins
+
+
+def percentile(sorted_values: List[int], pct: float) -> int:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def start():
+    parser = argparse.ArgumentParser(
+        description='Forecast who wins and how many more merges the game lasts.')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--authors', choices=['history', 'uniform'], default='history',
+                        help='who authors future merges: in proportion to past merges, or anyone equally')
+    parser.add_argument('--players', type=int, default=None,
+                        help='instead of the real game, use this many players with random points')
+    parser.add_argument('--top', type=int, default=20, help='how many players to list')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.players:
+        rng = random.Random(args.seed)
+        all_user_points = {'player%05d' % i: {'bonus': rng.randint(0, 20), 'merge': rng.randint(0, 20)}
+                           for i in range(args.players)}
+    else:
+        all_user_points = util.get_user_points()
+
+    summed_user_points = [(user, util.total_user_points(user_points))
+                          for user, user_points in all_user_points.items()]
+    weights = merge_weights(all_user_points, args.authors)
+    result = forecast(summed_user_points, weights)
+    lengths, wins = sample(summed_user_points, weights, args.samples, args.seed)
+    lengths.sort()
+
+    mean_length = sum(k * p for k, p in enumerate(result.length_pmf, 1))
+    print('Merges until someone wins (%s players, %s points):' % (
+        len(summed_user_points), sum(user_points for _, user_points in summed_user_points)))
+    print('  expected: %.1f' % mean_length)
+    print('  sampled: mean %.1f, %s' % (sum(lengths) / len(lengths), ', '.join(
+        'p%s %s' % (pct, percentile(lengths, pct)) for pct in PERCENTILES)))
+
+    print('\nChance of winning:')
+    print('  %-20s %9s %9s' % ('player', 'exact', 'sampled'))
+    ranked = sorted(zip(summed_user_points, wins), key=lambda item: -result.win_probabilities[item[0][0]])
+    for (user, _), user_wins in ranked[:args.top]:
+        print('  %-20s %8.3f%% %8.3f%%' % (
+            user, result.win_probabilities[user] * 100, user_wins * 100.0 / args.samples))
+    if len(ranked) > args.top:
+        print('  ... and %s more' % (len(ranked) - args.top))
+
+    print('\n%s games sampled in %.1fs%s' % (
+        args.samples, time.time() - start_time, '' if numpy is not None else ' (install numpy for speed)'))
+
+
+if __name__ == '__main__':
+    start()
@@ -0,0 +1,49 @@
+import argparse
+import json
+import time
+
+import points
+import util
+
+# Points at any revision, or after every merge, read from git without checking
+# anything out.
+
+
+def print_standings(user_points):
+    for user, points_by_type in user_points.items():
+        print('  %s: %s' % (user, util.total_user_points(points_by_type)))
+        for reason in points_by_type:
+            print('    %s: %s' % (reason, points_by_type[reason]))
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Show points at a revision, or after every merge.')
+    parser.add_argument('rev', nargs='?', default='master')
+    parser.add_argument('--timeline', action='store_true',
+                        help='show totals after every merge up to rev')
+    parser.add_argument('--json', action='store_true', help='print JSON instead')
+    args = parser.parse_args()
+
+    if not args.timeline:
+        user_points = points.user_points_at(args.rev)
+        if args.json:
+            print(json.dumps(user_points, indent=2, sort_keys=True))
+        else:
+            print('Points at %s:' % args.rev)
+            print_standings(user_points)
+        return
+
+    standings = points.timeline(args.rev)
+    if args.json:
+        print(json.dumps([standing._asdict() for standing in standings], indent=2, sort_keys=True))
+        return
+
+    for standing in standings:
+        print('%s %s %s' % (
+            time.strftime('%Y-%m-%d', time.gmtime(standing.committer_ts)), standing.sha[:8],
+            ' '.join('%s=%s' % (user, util.total_user_points(points_by_type))
+                     for user, points_by_type in standing.points.items())))
+
+
+if __name__ == '__main__':
+    start()
@@ -1,14 +1,15 @@
-from typing import List
+from typing import List, Optional
 
-class PatchSet:
+class PatchSet(List[PatchedFile]):
   def __init__(self, diff: str) -> None: ...
   modified_files: List[PatchedFile]
   added_files: List[PatchedFile]
   removed_files: List[PatchedFile]
 
-class PatchedFile:
+class PatchedFile(List[Hunk]):
   path: str
-  
+  patch_info: Optional[List[str]]
 
+class Hunk(List[Line]): ...
 
-  
+class Line: ...
@@ -0,0 +1,247 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import time
+from typing import Any, Dict, List, NamedTuple
+
+import pull_request
+import replay
+
+# Builds a game repository and a matching recording (see replay.py) from
+# scratch, so validate.py can be run and timed offline at any size:
+#
+#   <path>/repo      a checkout of master, with the harness from this tree
+#   <path>/fixtures  HTTP responses and git remotes for NOMIC_REPLAY
+#
+# Everything is deterministic given the parameters, so two builds with the
+# same parameters produce the same commits.
+
+REPO = 'synthetic/nomic'
+PR_NUMBER = '1'
+PR_BRANCH = 'synthetic-pr'
+
+# rule 0.25 derives these PRs, so they need to be there too.
+EXTRA_PR_NUMBERS = ['33', '82', '220']
+
+REVIEWS_PER_PAGE = 30
+START_TS = 1516291200  # 2018-01-18
+COMMIT_INTERVAL = 3600
+
+
+class Config(NamedTuple):
+    players: int = 5
+    merges: int = 100
+    review_pages: int = 1
+    stale_approvals: int = 1
+
+
+DEFAULT_CONFIG = Config()
+
+
+class Synthetic(NamedTuple):
+    config: Config
+    repo_dir: str
+    fixture_dir: str
+    repo: str
+    pr_number: str
+    head_sha: str
+
+
+def player_names(config: Config) -> List[str]:
+    return ['player%03d' % i for i in range(config.players)]
+
+
+def harness_files(source_dir: str) -> List[str]:
+    # The code from this tree, without the players.
+    output = subprocess.check_output(['git', 'ls-files', '--cached', '--others', '--exclude-standard'],
+                                     cwd=source_dir).decode('utf-8')
+    return [path for path in output.split('\n')
+            if path and not path.startswith('players/') and os.path.isfile(os.path.join(source_dir, path))]
+
+
+class _FastImport:
+    # Writes a `git fast-import` stream, which is far faster than running git
+    # once per commit.
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+        self.marks = 0
+        self.ts = START_TS
+
+    def data(self, data: bytes) -> None:
+        self.chunks.append(b'data %d\n' % len(data))
+        self.chunks.append(data + b'\n')
+
+    def commit(self, ref: str, message: str, parents: List[str], files: Dict[str, bytes]) -> str:
+        self.marks += 1
+        self.ts += COMMIT_INTERVAL
+        self.chunks.append(b'commit %s\nmark :%d\n' % (ref.encode('utf-8'), self.marks))
+        self.chunks.append(b'committer Synthetic <synthetic@localhost> %d +0000\n' % self.ts)
+        self.data(message.encode('utf-8'))
+        if parents:
+            self.chunks.append(b'from %s\n' % parents[0].encode('utf-8'))
+        for parent in parents[1:]:
+            self.chunks.append(b'merge %s\n' % parent.encode('utf-8'))
+        for path, contents in sorted(files.items()):
+            self.chunks.append(b'M 100644 inline %s\n' % path.encode('utf-8'))
+            self.data(contents)
+        return ':%d' % self.marks
+
+    def run(self, repo_dir: str) -> None:
+        subprocess.run(['git', 'fast-import', '--quiet'], cwd=repo_dir,
+                       input=b''.join(self.chunks), check=True)
+
+
+def _write_json_response(fixture_dir: str, url: str, value: Any, links: str = '') -> None:
+    body = json.dumps(value).encode('utf-8')
+    headers = {'Content-Type': 'application/json', 'ETag': '"%s"' % hashlib.sha256(body).hexdigest()}
+    if links:
+        headers['Link'] = links
+    replay.write_response(fixture_dir, url, headers, body)
+
+
+def build_repo(config: Config, repo_dir: str, source_dir: str) -> None:
+    players = player_names(config)
+    os.makedirs(repo_dir)
+    subprocess.check_call(['git', 'init', '--quiet', repo_dir])
+
+    files = {}
+    for path in harness_files(source_dir):
+        with open(os.path.join(source_dir, path), 'rb') as inf:
+            files[path] = inf.read()
+    for player in players:
+        files['players/%s/bonuses/initial' % player] = b'0\n'
+
+    stream = _FastImport()
+    master = stream.commit('refs/heads/master', 'Start the game', [], files)
+
+    # Each merge is a one-commit PR branch merged with --no-ff, the way GitHub
+    # merges PRs, so that points count one merge for its author.
+    for i in range(config.merges):
+        player = players[i % len(players)]
+        change = {'synthetic/merges': b'%d\n' % i}
+        branch = stream.commit('refs/synthetic/work', 'Change %d' % i, [master], change)
+        master = stream.commit('refs/heads/master', 'Merge pull request #%d from %s/change-%d\n\nChange %d' % (
+            i + 2, player, i, i), [master, branch], change)
+
+    # The PR under review: one commit per stale approval, and then the head.
+    head = master
+    for i in range(config.stale_approvals + 1):
+        head = stream.commit('refs/heads/%s' % PR_BRANCH, 'Proposal, revision %d' % i, [head], {
+            'synthetic/proposal': b'revision %d\n' % i})
+
+    stream.run(repo_dir)
+    subprocess.check_call(['git', 'update-ref', '-d', 'refs/synthetic/work'], cwd=repo_dir)
+    subprocess.check_call(['git', 'reset', '--quiet', '--hard', 'master'], cwd=repo_dir)
+
+
+def build_fixtures(config: Config, repo_dir: str, fixture_dir: str) -> str:
+    # Returns the PR's head commit.
+    players = player_names(config)
+
+    def rev_parse(rev: str) -> str:
+        return subprocess.check_output(['git', 'rev-parse', rev], cwd=repo_dir).decode('utf-8').strip()
+
+    head = rev_parse(PR_BRANCH)
+    revisions = [rev_parse('%s~%d' % (PR_BRANCH, i))
+                 for i in range(config.stale_approvals, 0, -1)]
+    diff = subprocess.check_output(['git', 'diff', 'master...%s' % PR_BRANCH], cwd=repo_dir)
+
+    # Both upstream and the author's fork are this repository.
+    clone_url = 'https://github.com/%s-fork/nomic.git' % players[0]
+    os.makedirs(os.path.join(fixture_dir, 'git'))
+    for url in ['https://github.com/%s.git' % REPO, clone_url]:
+        os.symlink(os.path.abspath(os.path.join(repo_dir, '.git')), replay.git_fixture_path(fixture_dir, url))
+
+    # Reviews, in order: approvals at old revisions, which no longer count since
+    # the proposal changed after them, then comments to fill out the pages,
+    # then approvals of the head from everyone else.  Each stale approval is
+    # from a different player where there are enough of them, so each one is
+    # checked.  The author approves implicitly, and the last player never
+    # reviews, so the PR isn't unanimous and every rule runs.
+    reviewers = players[1:-1] or players
+    reviews = [{'user': {'login': reviewers[i % len(reviewers)]}, 'state': 'APPROVED', 'commit_id': revision}
+               for i, revision in enumerate(revisions)]
+    approvers = reviewers[len(revisions):]
+    approvals = [{'user': {'login': player}, 'state': 'APPROVED', 'commit_id': head} for player in approvers]
+    filler = config.review_pages * REVIEWS_PER_PAGE - len(reviews) - len(approvals)
+    reviews += [{'user': {'login': players[i % len(players)]}, 'state': 'COMMENTED', 'commit_id': head}
+                for i in range(max(0, filler))] + approvals
+    pages = [reviews[start:start + REVIEWS_PER_PAGE]
+             for start in range(0, len(reviews), REVIEWS_PER_PAGE)] or [[]]
+
+    pr_numbers = [PR_NUMBER] + EXTRA_PR_NUMBERS
+    for pr_number in pr_numbers:
+        pr_url = '%s/%s' % (pull_request.pulls_url(REPO), pr_number)
+        github_reviews_url = 'https://api.github.com/repos/%s/pulls/%s/reviews' % (REPO, pr_number)
+        _write_json_response(fixture_dir, pr_url, {
+            'number': int(pr_number),
+            'state': 'open',
+            'labels': [{'name': 'reviewme'}],
+            'user': {'login': players[0]},
+            'created_at': '2018-01-01T00:00:00Z',
+            'updated_at': '2018-01-01T00:00:00Z',
+            'head': {'sha': head, 'ref': PR_BRANCH,
+                     'repo': {'clone_url': clone_url, 'pushed_at': '2018-01-01T00:00:00Z'}},
+        })
+        for page_number, page in enumerate(pages, 1):
+            links = []
+            if page_number < len(pages):
+                links.append('<%s?page=%d>; rel="next"' % (github_reviews_url, page_number + 1))
+                links.append('<%s?page=%d>; rel="last"' % (github_reviews_url, len(pages)))
+            url = '%s/reviews' % pr_url
+            if page_number > 1:
+                url += '?page=%d' % page_number
+            _write_json_response(fixture_dir, url, page, ', '.join(links))
+        replay.write_response(
+            fixture_dir, 'https://patch-diff.githubusercontent.com/raw/%s/pull/%s.diff' % (REPO, pr_number),
+            {'Content-Type': 'text/plain'}, diff)
+
+    _write_json_response(fixture_dir, '%s?state=open&per_page=100' % pull_request.pulls_url(REPO), [{
+        'number': int(pr_number), 'labels': [{'name': 'reviewme'}], 'head': {'sha': head}}
+        for pr_number in pr_numbers])
+    return head
+
+
+def generate(config: Config, path: str, source_dir: str = '.') -> Synthetic:
+    repo_dir = os.path.join(path, 'repo')
+    fixture_dir = os.path.join(path, 'fixtures')
+    build_repo(config, repo_dir, source_dir)
+    head = build_fixtures(config, repo_dir, fixture_dir)
+    return Synthetic(config=config, repo_dir=repo_dir, fixture_dir=fixture_dir, repo=REPO,
+                     pr_number=PR_NUMBER, head_sha=head)
+
+
+def environment(synthetic: Synthetic) -> Dict[str, str]:
+    # What validate.py needs to check the synthetic PR against the recording.
+    return {
+        replay.REPLAY_ENV: os.path.abspath(synthetic.fixture_dir),
+        'TRAVIS_REPO_SLUG': synthetic.repo,
+        'TRAVIS_PULL_REQUEST': synthetic.pr_number,
+        'TRAVIS_PULL_REQUEST_SHA': synthetic.head_sha,
+    }
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Build a synthetic game repository and recording.')
+    parser.add_argument('path', help='directory to create')
+    parser.add_argument('--players', type=int, default=DEFAULT_CONFIG.players)
+    parser.add_argument('--merges', type=int, default=DEFAULT_CONFIG.merges)
+    parser.add_argument('--review-pages', type=int, default=DEFAULT_CONFIG.review_pages)
+    parser.add_argument('--stale-approvals', type=int, default=DEFAULT_CONFIG.stale_approvals)
+    args = parser.parse_args()
+
+    config = Config(players=args.players, merges=args.merges, review_pages=args.review_pages,
+                    stale_approvals=args.stale_approvals)
+    start_time = time.time()
+    synthetic = generate(config, args.path)
+    print('Built %s in %.1fs.  To check the PR:\n' % (args.path, time.time() - start_time))
+    print('  cd %s' % synthetic.repo_dir)
+    print('  %s NOMIC_CACHE_DIR=%s python3 validate.py' % (
+        ' '.join('%s=%s' % item for item in sorted(environment(synthetic).items())),
+        os.path.abspath(os.path.join(args.path, 'cache'))))
+
+
+if __name__ == '__main__':
+    start()
@@ -0,0 +1,113 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List
+
+# Spans are always collected, since timing a span costs about as much as a
+# dict append, and a summary is printed at the end of each run.  Set
+# NOMIC_TRACE to a filename to also write every span there in Chrome's trace
+# event format, for chrome://tracing or https://ui.perfetto.dev.
+TRACE_ENV = 'NOMIC_TRACE'
+
+# Past this many spans we stop keeping them, so a runaway loop can't eat
+# memory.  The summary says how many were dropped.
+MAX_SPANS = 100000
+
+SLOWEST_SPANS = 10
+
+_start = time.perf_counter()
+_spans: List[Dict[str, Any]] = []
+_dropped = 0
+_spans_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(category: str, name: str, **args: Any) -> Iterator[Dict[str, Any]]:
+    # Times the body of the with statement.  Callers can add to the yielded
+    # dict anything they only learn along the way, like an HTTP status.
+    start = time.perf_counter()
+    try:
+        yield args
+    except Exception as e:
+        args['error'] = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        end = time.perf_counter()
+        _record({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - _start) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+
+def _record(event: Dict[str, Any]) -> None:
+    global _dropped
+    with _spans_lock:
+        if len(_spans) < MAX_SPANS:
+            _spans.append(event)
+        else:
+            _dropped += 1
+
+
+def reset() -> None:
+    # For long-running processes, which report on one piece of work at a time.
+    global _dropped
+    with _spans_lock:
+        del _spans[:]
+        _dropped = 0
+
+
+def spans() -> List[Dict[str, Any]]:
+    with _spans_lock:
+        return list(_spans)
+
+
+def write_trace(fname: str) -> None:
+    with open(fname, 'w') as outf:
+        # Anything in args that JSON can't represent is written as a string.
+        json.dump({'traceEvents': spans(), 'displayTimeUnit': 'ms'}, outf, default=str)
+
+
+def print_summary() -> None:
+    events = spans()
+    if not events:
+        return
+
+    by_category: Dict[str, List[Dict[str, Any]]] = {}
+    for event in events:
+        by_category.setdefault(event['cat'], []).append(event)
+
+    # Spans nest and overlap across threads, so totals can add up to more than
+    # the wall time of the run.
+    print('\nTimings:')
+    print('  %-10s %6s %9s %9s  %s' % ('category', 'count', 'total', 'max', 'slowest'))
+    for category, category_events in sorted(by_category.items()):
+        slowest = max(category_events, key=lambda event: event['dur'])
+        print('  %-10s %6s %8.3fs %8.3fs  %s' % (
+            category, len(category_events),
+            sum(event['dur'] for event in category_events) / 1e6,
+            slowest['dur'] / 1e6, slowest['name']))
+
+    print('Slowest:')
+    for event in sorted(events, key=lambda event: -event['dur'])[:SLOWEST_SPANS]:
+        print('  %8.3fs %-10s %s' % (event['dur'] / 1e6, event['cat'], event['name']))
+
+    if _dropped:
+        print('(%s spans dropped after the first %s)' % (_dropped, MAX_SPANS))
+
+
+def report() -> None:
+    # Call once at the end of a run.
+    fname = os.environ.get(TRACE_ENV)
+    if fname:
+        write_trace(fname)
+    print_summary()
+    if fname:
+        print('Trace written to %s' % fname)
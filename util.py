@@ -1,25 +1,142 @@
 import os
-import re
-import requests
 import subprocess
+import threading
 import time
-from typing import Dict, List
-
-
-def request(url: str) -> requests.Response:
-    request_headers = {'User-Agent': 'jeffkaufman/nomic'}
-    response = requests.get(url, headers=request_headers)
-
-    for header in ['X-RateLimit-Limit',
-                   'X-RateLimit-Remaining',
-                   'X-RateLimit-Reset']:
-        if header in response.headers:
-            print('    > %s: %s' % (header, response.headers[header]))
-
-    if response.status_code != 200:
-        print('   > %s' % response.content)
-
-    response.raise_for_status()
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import cache
+import capture
+import git_repo
+import http_cache
+import points as points_ledger
+import ratelimit
+import replay
+import tracing
+
+# requests takes longer to import than everything else we use put together,
+# and checking for a winner never needs it, so it's imported when the first
+# request is made.
+if TYPE_CHECKING:
+    import requests
+
+# Upper bound on concurrent connections to any one host, and so on how many
+# requests request_all has in flight at once.
+MAX_POOL_SIZE = 8
+
+# When offline, requests are answered from the HTTP cache without asking the
+# server whether they're current, and fail if they aren't cached.
+_offline = False
+
+_session: Optional['requests.Session'] = None
+_session_lock = threading.Lock()
+
+
+def session() -> 'requests.Session':
+    # One session for the whole process, so connections to the proxy and to
+    # GitHub are kept alive and reused instead of paying for a new TCP+TLS
+    # handshake on every request.
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            new_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                    pool_maxsize=MAX_POOL_SIZE)
+            new_session.mount('https://', adapter)
+            new_session.mount('http://', adapter)
+            new_session.headers.update({
+                'User-Agent': 'jeffkaufman/nomic',
+                'Accept-Encoding': 'gzip, deflate',
+            })
+            _session = new_session
+        return _session
+
+
+def set_offline(offline: bool) -> None:
+    global _offline
+    _offline = offline
+
+
+def request(url: str) -> 'requests.Response':
+    request_headers: Dict[str, str] = {}
+
+    # If we've seen this URL before, ask the server whether it has changed
+    # since, and if not reuse the copy on disk.
+    cached = http_cache.lookup(url)
+    if _offline:
+        if not cached:
+            raise Exception('Offline, and %s is not cached' % url)
+        cache.count('http', 'offline')
+        return cached_response(cached)
+    if cached:
+        request_headers.update(cached.validators())
+
+    budget = ratelimit.budget()
+    with tracing.span('http', url) as span:
+        attempt = 0
+        while True:
+            budget.wait_turn(ratelimit.priority())
+            response = session().get(replay.request_url(url), headers=request_headers)
+            budget.observe(response.headers)
+
+            # Secondary rate limits and server errors are usually transient.
+            delay = budget.retry_delay(response, attempt)
+            if delay is None:
+                break
+            print('   > %s from %s, retrying in %.0fs' % (response.status_code, url, delay))
+            time.sleep(delay)
+            attempt += 1
+
+        span['status'] = response.status_code
+        span['bytes'] = len(response.content)
+        span['attempts'] = attempt + 1
+
+        for header in ['X-RateLimit-Limit',
+                       'X-RateLimit-Remaining',
+                       'X-RateLimit-Reset']:
+            if header in response.headers:
+                print('    > %s: %s' % (header, response.headers[header]))
+                span[header] = response.headers[header]
+
+        if response.status_code == 304 and cached:
+            cache.count('http', 'hits')
+            response = cached_response(http_cache.revalidated(cached, response.headers))
+        else:
+            if response.status_code != 200:
+                print('   > %s' % response.content)
+
+            response.raise_for_status()
+
+            cache.count('http', 'misses')
+            http_cache.store(url, response.headers, response.content)
+
+        replay.record_response(url, response)
+        return response
+
+
+def request_all(urls: List[str]) -> List['requests.Response']:
+    # Fetch several independent URLs at once, returning responses in the same
+    # order as the urls.  Raises if any of them fail, like request().
+    if len(urls) < 2:
+        return [request(url) for url in urls]
+
+    # What the requests print goes wherever ours would, even when this
+    # thread's output is being captured.
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(urls), MAX_POOL_SIZE)) as executor:
+        return list(executor.map(capture.propagating(request), urls))
+
+
+def cached_response(entry: http_cache.Entry) -> 'requests.Response':
+    # Rebuild a response from the cache that looks to callers (.json(),
+    # .content, .links) like one that just came over the network.
+    import requests
+    response = requests.Response()
+    response.status_code = 200
+    response.url = entry.url
+    response.headers = requests.structures.CaseInsensitiveDict(entry.headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = entry.body()
     return response
 
 
@@ -33,7 +150,8 @@ def users() -> List[str]:
 
 def latest_master_commit_info(log_format) -> str:
     cmd = ['git', 'log', 'master', '-1', '--format=%s' % log_format]
-    completed_process = subprocess.run(cmd, stdout=subprocess.PIPE)
+    with tracing.span('git', 'git log', args=' '.join(cmd[2:])):
+        completed_process = subprocess.run(cmd, stdout=subprocess.PIPE)
     if completed_process.returncode != 0:
         raise Exception(completed_process)
 
@@ -42,12 +160,12 @@ def latest_master_commit_info(log_format) -> str:
 
 def last_commit_ts() -> int:
     # When was the last commit on master?
-    return int(latest_master_commit_info(log_format='%ct'))
+    return git_repo.repository().commit('master').committer_ts
 
 
 def last_commit_sha() -> str:
     # What is the commit sha of the last commit on master?
-    return latest_master_commit_info(log_format='%H').strip()
+    return git_repo.repository().resolve('master')
 
 
 def seconds_since(ts) -> int:
@@ -87,39 +205,11 @@ def get_user_points() -> Dict[str, Dict[str, int]]:
                 with open(os.path.join(bonus_directory, named_bonus)) as inf:
                     points[user]['bonus'] += int(inf.read())
 
-    # Iterate through all commits in reverse chronological order, assigning
-    # points to PR authors.
-    #
-    # We only look at master, and we look at the --first-parent history which
-    # just shows the merges: http://www.davidchudzicki.com/posts/first-parent/
-    cmd = ['git', 'log', 'master', '--first-parent', '--format=%H %s']
-    completed_process = subprocess.run(cmd, stdout=subprocess.PIPE)
-    if completed_process.returncode != 0:
-        raise Exception(completed_process)
-    process_output = completed_process.stdout.decode('utf-8')
-
-    # This can't fully be trusted, since it's under the control of the person who
-    # merges the PR, except that editing the merge text on GitHub is out of
-    # bounds.
-    merge_regexp = '^Merge pull request #[\\d]* from ([^/]*)/'
-    for line in process_output.split('\n'):
-        if not line.strip():
-            continue
-
-        commit_hash, commit_subject = line.split(' ', 1)
-
-        if commit_hash == 'e5229a56a942126dc35c463d0f94f348b3d5389a':
-            # Only look at PRs merged since restarting the game.
-            break
-
-        match = re.match(merge_regexp, commit_subject)
-        if match:
-            # Regexp match means this is a merge commit.
-
-            commit_username, = match.groups()
-
-            if commit_username in points:
-                points[commit_username]['merge'] += 1
+    # Merges are counted from the first-parent history of master, picking up
+    # where the last run left off.
+    merges = points_ledger.merge_counts(last_commit_sha())
+    for user in points:
+        points[user]['merge'] = merges.get(user, 0)
 
     return points
 
@@ -1,15 +1,30 @@
+import filecmp
 import os
-import runpy
-import copy
-import traceback
+import subprocess
+import sys
+from typing import NamedTuple, Optional
+import cache
+import capture
+import game_state
+import git_mirror
+import ratelimit
+import rule_loader
+import tracing
 import util
 import pull_request
+import verdict_cache
+import winner
 
 
-def print_points():
+# About how many API requests checking one PR takes: the PR and its reviews,
+# plus the PRs rule 0.25 tests against.
+ESTIMATED_REQUESTS = 15
+
+
+def print_points(state: game_state.GameState):
     print('Points:')
-    for user, user_points in util.get_user_points().items():
-        print('  %s: %s' % (user, util.total_user_points(user_points)))
+    for user, user_points in state.user_points.items():
+        print('  %s: %s' % (user, state.total_points[user]))
         for reason in user_points:
             print('    %s: %s' % (reason, user_points[reason]))
 
@@ -22,24 +37,27 @@ def print_users():
 
 
 def print_file_changes(pr):
-    diff = pr.diff()
+    summary = pr.diff_summary()
     print('\n')
-    for category, category_list in [('added', diff.added_files),
-                                    ('modified', diff.modified_files),
-                                    ('removed', diff.removed_files)]:
+    for category, category_list in [('added', summary.added),
+                                    ('modified', summary.modified),
+                                    ('removed', summary.removed)]:
 
         if category_list:
             print('%s:' % category)
-            for patched_file in category_list:
-                print('  %s' % patched_file.path)
+            for path in category_list:
+                print('  %s' % path)
     print()
 
 
 def print_status(pr):
     print('\nAuthor: %s' % pr.author())
 
+    # Working out reviews can print about old approvals, so do that first.
+    reviews = pr.reviews
+
     print('\nReviews:')
-    for user, state in sorted(pr.reviews.items()):
+    for user, state in sorted(reviews.items()):
         print('  %s: %s' % (user, state))
 
     print('Approvals: %s - %s' % (len(pr.approvals), ' '.join(pr.approvals)))
@@ -52,12 +70,9 @@ def print_status(pr):
     print_file_changes(pr)
 
 
-def determine_if_mergeable(pr):
-    print_points()
-    print_status(pr)
-
+def list_rules(rules_dir='rules'):
     rules = []
-    for rule_fname in os.listdir('rules'):
+    for rule_fname in os.listdir(rules_dir):
         rule_priority_str, allow_block, rule_name = rule_fname.split('-', 2)
         rule_name, _ = rule_name.rsplit('.', 1)
         if allow_block not in ['allow', 'block']:
@@ -66,39 +81,147 @@ def determine_if_mergeable(pr):
         is_allow = allow_block == 'allow'
 
         rules.append((float(rule_priority_str),
-                      os.path.join('rules', rule_fname),
+                      os.path.join(rules_dir, rule_fname),
                       rule_name,
                       is_allow))
 
-    # Go through rules sorted by priority, with ties broken by the filename.
-    for rule_priority, rule_full_fname, rule_name, is_allow in sorted(rules):
-        print('\nRunning rule %s' % rule_full_fname)
+    # Sorted by priority, with ties broken by the filename.
+    return sorted(rules)
 
-        pr_copy = copy.deepcopy(pr)
 
-        rule_py = runpy.run_path(rule_full_fname)
-        fn = rule_py['should_allow' if is_allow else 'should_block']
+def run_block_rule(rule_full_fname, pr, state):
+    with tracing.span('rule', rule_full_fname) as span:
+        rule_py = rule_loader.run_rule(rule_full_fname)
+        fn = rule_py['should_block']
 
-        if is_allow:
-            try:
-                # Returns truthy to indicate allowing, anything else including raising
-                # for no judgement.
-                if fn(pr_copy):
-                    print('\nPASS: %s' % rule_name)
-                    return
-            except Exception as e:
-                traceback.print_exc()
-                print('  %s: %s' % (rule_full_fname, e))
-        else:
+        # The verdict is the message it blocked with, or None.
+        rule_run = verdict_cache.RuleRun(rule_full_fname, rule_py, pr, state)
+        if rule_run.cached:
+            span['cached'] = True
+            message = rule_run.replay()
+            if message is not None:
+                raise Exception(message)
+            return
+
+        with rule_run.recording():
             # Raises an exception to indicate blocking, anything else for no
             # judgement.
-            fn(pr_copy)
+            try:
+                rule_loader.call_rule(fn, rule_run.pr, rule_run.state)
+            except Exception as e:
+                rule_run.decide(str(e))
+                raise
+            rule_run.decide(None)
+
+
+def run_block_rule_captured(rule_full_fname, pr, state):
+    # Returns (what the rule printed, exception if it blocked).
+    with capture.captured_output() as output:
+        try:
+            run_block_rule(rule_full_fname, pr, state)
+        except Exception as e:
+            return output.getvalue(), e
+    return output.getvalue(), None
+
+
+def start_block_rules(rules, pr, state):
+    # With NOMIC_PARALLEL_RULES=1, start every block rule at once in a thread
+    # pool, since they're independent and the slow ones (pycodestyle, mypy,
+    # fetching test PRs) mostly wait on subprocesses and the network.  Their
+    # output is held back and their verdicts are only looked at when
+    # determine_if_mergeable reaches them in priority order, so the results
+    # and output are the same as running them one at a time.
+    if os.environ.get('NOMIC_PARALLEL_RULES', '0') == '0':
+        return None, {}
+
+    block_rules = [rule_full_fname for _, rule_full_fname, _, is_allow in rules
+                   if not is_allow]
+    if not block_rules:
+        return None, {}
+
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=len(block_rules))
+    return executor, {rule_full_fname: executor.submit(run_block_rule_captured, rule_full_fname, pr, state)
+                      for rule_full_fname in block_rules}
+
+
+class Verdict(NamedTuple):
+    allowed: bool
+    rule: Optional[str]  # The rule that decided, if one did.
+    reason: str
+    exception: Optional[Exception]  # What the blocking rule raised.
+
+
+def evaluate_rules(pr, state: Optional[game_state.GameState] = None, rules_dir='rules') -> Verdict:
+    if state is None:
+        state = game_state.snapshot()
+    print_points(state)
+    print_status(pr)
+
+    rules = list_rules(rules_dir)
+    executor, block_futures = start_block_rules(rules, pr, state)
+    try:
+        for rule_priority, rule_full_fname, rule_name, is_allow in rules:
+            print('\nRunning rule %s' % rule_full_fname)
+
+            if is_allow:
+                with tracing.span('rule', rule_full_fname) as span:
+                    rule_py = rule_loader.run_rule(rule_full_fname)
+                    fn = rule_py['should_allow']
+
+                    rule_run = verdict_cache.RuleRun(rule_full_fname, rule_py, pr, state)
+                    if rule_run.cached:
+                        span['cached'] = True
+                        allowed = rule_run.replay()
+                    else:
+                        with rule_run.recording():
+                            try:
+                                # Returns truthy to indicate allowing, anything else including raising
+                                # for no judgement.
+                                allowed = rule_loader.call_rule(fn, rule_run.pr, rule_run.state)
+                            except Exception as e:
+                                span['error'] = '%s: %s' % (type(e).__name__, e)
+                                import traceback
+                                traceback.print_exc()
+                                print('  %s: %s' % (rule_full_fname, e))
+                                allowed = False
+                            rule_run.decide(bool(allowed))
+
+                if allowed:
+                    print('\nPASS: %s' % rule_name)
+                    return Verdict(True, rule_full_fname, 'PASS: %s' % rule_name, None)
+            else:
+                try:
+                    if rule_full_fname in block_futures:
+                        output, block_exception = block_futures[rule_full_fname].result()
+                        sys.stdout.write(output)
+                        if block_exception:
+                            raise block_exception
+                    else:
+                        run_block_rule(rule_full_fname, pr, state)
+                except Exception as e:
+                    return Verdict(False, rule_full_fname, str(e), e)
+    finally:
+        # Once we have an answer, rules that haven't started yet don't need to.
+        for future in block_futures.values():
+            future.cancel()
+        if executor:
+            executor.shutdown(wait=False)
 
     print('\nPASS')
+    return Verdict(True, None, 'PASS', None)
 
 
-def determine_if_winner():
-    print_points()
+def determine_if_mergeable(pr, state: Optional[game_state.GameState] = None):
+    verdict = evaluate_rules(pr, state)
+    if verdict.exception:
+        raise verdict.exception
+
+
+def determine_if_winner(state: Optional[game_state.GameState] = None):
+    if state is None:
+        state = game_state.snapshot()
+    print_points(state)
 
     # Pick a winner at random with a single random number.  We divide the number
     # line up like:
@@ -126,45 +249,109 @@ def determine_if_winner():
     # Relative chance per-player is still preserved.
 
     rnd = util.random()
-    all_user_points = util.get_user_points()
-
-    summed_user_points = [(user, util.total_user_points(user_points))
-                          for user, user_points in all_user_points.items()]
-
-    # Don't include negative values when summing user points,
-    # since they have no chance to win anyway
-    # There shouldn't be negative values, but just in case...
-    total_points = sum([user_points for user, user_points
-                        in summed_user_points if user_points > 0])
+    summed_user_points = list(state.total_points.items())
 
-    scalar = min(0.00001, 1.0 / total_points)
-    points_so_far = 0
+    # There shouldn't be negative values, but just in case the table handles
+    # them the same way as always.
+    table = winner.WinnerTable(summed_user_points)
 
     print('Probability of winning:')
     for user, user_points in summed_user_points:
-        print('%s: %.3f%%' % (user, user_points * scalar * 100))
+        print('%s: %.3f%%' % (user, table.chance(user_points) * 100))
 
-    for user, user_points in summed_user_points:
-        if rnd < scalar * (user_points + points_so_far):
-            raise Exception('%s wins!' % user)
-        points_so_far += user_points
+    winning_user = table.winner(rnd)
+    if winning_user is not None:
+        raise Exception('%s wins!' % winning_user)
 
     print('The game continues.')
 
 
-def start():
-    travis_pull_request = os.environ['TRAVIS_PULL_REQUEST']
+# Settings that name files or directories, and would mean something else once
+# we change directory into master's worktree.
+PATH_VARIABLES = ['NOMIC_CACHE_DIR', 'NOMIC_RECORD', 'NOMIC_REPLAY', 'NOMIC_TRACE']
+
+
+def validate_checkout(shared_pr: Optional[pull_request.PullRequest] = None) -> Optional[pull_request.PullRequest]:
+    # Validate by the rules and players in the current directory.  Returns the
+    # PR, if there was one, so a later phase can share it.
+    state = game_state.snapshot()
+    if os.environ['TRAVIS_PULL_REQUEST'] == 'false':
+        determine_if_winner(state)
+        return None
 
-    if travis_pull_request == 'false':
-        determine_if_winner()
+    if shared_pr is not None:
+        pr = shared_pr.for_users(list(state.users))
     else:
-        target_commit = os.environ['TRAVIS_PULL_REQUEST_SHA']
-        repo_slug = os.environ['TRAVIS_REPO_SLUG']
-        determine_if_mergeable(pull_request.PullRequest(
-            repo=repo_slug,
-            pr_number=travis_pull_request,
-            target_commit=target_commit,
-            users=util.users()))
+        pr = pull_request.PullRequest(
+            repo=os.environ['TRAVIS_REPO_SLUG'],
+            pr_number=os.environ['TRAVIS_PULL_REQUEST'],
+            target_commit=os.environ['TRAVIS_PULL_REQUEST_SHA'],
+            users=list(state.users))
+    determine_if_mergeable(pr, state)
+    return pr
+
+
+def runs_same_code(checkout: str) -> bool:
+    # Rules import our modules, so master's rules can only run in this process
+    # if master's modules are the ones we already have loaded.
+    here = os.path.dirname(os.path.abspath(__file__))
+    modules = sorted(fname for fname in os.listdir(here) if fname.endswith('.py'))
+    if modules != sorted(fname for fname in os.listdir(checkout) if fname.endswith('.py')):
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(here, checkout, modules, shallow=False)
+    return not mismatch and not errors
+
+
+def validate_two_phase() -> None:
+    # What validate-on-master.sh does, validating by the rules on master and
+    # then by the proposed rules, but in one process.  Instead of a fresh
+    # clone, master is checked out from our mirror into a worktree that's kept
+    # between runs, and the PR is only loaded once.
+    for variable in PATH_VARIABLES:
+        if os.environ.get(variable):
+            os.environ[variable] = os.path.abspath(os.environ[variable])
+
+    mirror = git_mirror.mirror(os.environ['TRAVIS_REPO_SLUG'])
+    master = mirror.master_sha()
+    pr = None
+    with mirror.checkout('master-%s' % mirror.repo.replace('/', '-'), master) as master_checkout:
+        print('Validating by the rules on master (%s):' % master)
+        if runs_same_code(master_checkout):
+            proposed_checkout = os.getcwd()
+            os.chdir(master_checkout)
+            try:
+                pr = validate_checkout()
+            finally:
+                os.chdir(proposed_checkout)
+        else:
+            # Master's rules need master's code.
+            print('master has different code from this checkout; running it separately')
+            sys.stdout.flush()
+            returncode = subprocess.run([sys.executable, 'validate.py', 'master'],
+                                        cwd=master_checkout).returncode
+            if returncode != 0:
+                sys.exit(returncode)
+
+    print('\nValidating by the proposed rules:')
+    validate_checkout(pr)
+
+
+def start():
+    # validate-on-master.sh runs us as "validate.py master" in a clone of
+    # master and then as "validate.py proposed" here, which both mean validate
+    # what's in the current directory.  "validate.py two-phase" does both.
+    two_phase = sys.argv[1:] == ['two-phase']
+
+    try:
+        if os.environ['TRAVIS_PULL_REQUEST'] != 'false':
+            ratelimit.check(ESTIMATED_REQUESTS)
+        if two_phase:
+            validate_two_phase()
+        else:
+            validate_checkout()
+    finally:
+        cache.print_stats()
+        tracing.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,264 @@
+import contextlib
+import os
+import sys
+import threading
+import time
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import cache
+import capture
+import game_state
+import pull_request
+import rule_loader
+
+# Restarting a build after the last approval comes in runs every rule again,
+# though usually only the approvals changed.  A rule that sets PURE = True
+# promises that its verdict depends only on its own source and on what it
+# reads from the pr and state it's passed.  For those we remember, by rule
+# source, PR commit and master, everything the rule read and what it decided
+# and printed.  If everything it read is the same next time, that verdict is
+# reused without running the rule.
+#
+# Set NOMIC_NO_VERDICT_CACHE=1 to run every rule anyway.
+
+# How many master commits to remember verdicts for, like approval_index.
+MAX_MASTERS = 20
+
+# Different sets of inputs to remember per rule, PR commit and master: a
+# handful of approvals coming in one at a time.
+MAX_ENTRIES_PER_KEY = 10
+
+
+class Unrecordable(Exception):
+    pass
+
+
+def _jsonable(value: Any) -> Any:
+    # A copy of value that can be stored as JSON and compared with what we
+    # read next time.
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (set, frozenset)):
+        try:
+            return sorted(_jsonable(item) for item in value)
+        except TypeError:
+            raise Unrecordable('unsortable set')
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, Mapping):
+        if not all(isinstance(key, str) for key in value):
+            raise Unrecordable('mapping with non-string keys')
+        return {key: _jsonable(item) for key, item in value.items()}
+    raise Unrecordable(type(value).__name__)
+
+
+def _outcome(read: Callable[[], Any]) -> List[Any]:
+    # What reading an input gave, as ['value', value] or ['raised', message].
+    try:
+        value = read()
+    except Exception as e:
+        return ['raised', '%s: %s' % (type(e).__name__, e)]
+    return ['value', _jsonable(value)]
+
+
+def _read(target: Any, name: str, args: Optional[List[Any]]) -> Any:
+    value = getattr(target, name)
+    if args is not None:
+        value = value(*args)
+    return value
+
+
+class Inputs:
+    # Everything one run of a rule read from its pr and state, as a list of
+    # [source, name, args or None for attributes, outcome].
+    def __init__(self) -> None:
+        self.reads: List[List[Any]] = []
+        self._seen: Dict[str, bool] = {}
+        self.unrecordable: Optional[str] = None
+        # Methods run against the view, so what they read themselves comes
+        # back through observe(); only the call itself is an input.
+        self._calls = 0
+
+    def _record(self, source: str, name: str, args: Optional[List[Any]], outcome: Callable[[], List[Any]]) -> None:
+        try:
+            read = [source, name, None if args is None else _jsonable(args)]
+            seen_key = repr(read)
+            if seen_key not in self._seen:
+                self._seen[seen_key] = True
+                self.reads.append(read + [outcome()])
+        except Unrecordable as e:
+            self.unrecordable = '%s.%s: %s' % (source, name, e)
+
+    def observe(self, source: str, name: str, value: Any) -> Any:
+        if self._calls:
+            return value
+        if not callable(value):
+            self._record(source, name, None, lambda: ['value', _jsonable(value)])
+            return value
+
+        def call(*args, **kwargs):
+            if kwargs:
+                self.unrecordable = '%s.%s called with keyword arguments' % (source, name)
+                return value(*args, **kwargs)
+            self._calls += 1
+            try:
+                result = value(*args)
+            except Exception as e:
+                self._record(source, name, list(args), lambda: ['raised', '%s: %s' % (type(e).__name__, e)])
+                raise
+            finally:
+                self._calls -= 1
+            self._record(source, name, list(args), lambda: ['value', _jsonable(result)])
+            return result
+        return call
+
+
+class RecordingPullRequestView(pull_request.PullRequestView):
+    # A PullRequestView that notes what the rule read from the PR.  Only the
+    # first read of each attribute comes from the PR; after that a rule sees
+    # its own copy, which it may have changed.
+    def __init__(self, pr: pull_request.PullRequest, inputs: Inputs):
+        super().__init__(pr)
+        object.__setattr__(self, '_view_inputs', inputs)
+
+    def __getattr__(self, name: str):
+        if name in self._view_overrides:
+            return self._view_overrides[name]
+        return self._view_inputs.observe('pr', name, super().__getattr__(name))
+
+
+class RecordingState:
+    # The same for the GameState, which can't be changed, so nothing is copied.
+    def __init__(self, state: game_state.GameState, inputs: Inputs):
+        self._state = state
+        self._inputs = inputs
+
+    def __getattr__(self, name: str):
+        return self._inputs.observe('state', name, getattr(self._state, name))
+
+
+class VerdictStore:
+    # Persistent, per repo:
+    #
+    #   master sha -> '<rule source hash> <PR number> <PR commit>' -> list of
+    #                 {inputs, verdict, output}
+    def __init__(self, repo: str):
+        self._path = os.path.join(cache.cache_dir('verdicts'), '%s.json' % repo.replace('/', '-'))
+        self._lock = threading.Lock()
+        self._data: Dict[str, Any] = cache.read_json(self._path, default={})
+
+    def entries(self, master: str, key: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._data.get(master, {}).get('verdicts', {}).get(key, []))
+
+    def add(self, master: str, key: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            master_entry = self._data.setdefault(master, {'verdicts': {}})
+            master_entry['used'] = int(time.time())
+            entries = [existing for existing in master_entry['verdicts'].get(key, [])
+                       if existing['inputs'] != entry['inputs']]
+            master_entry['verdicts'][key] = (entries + [entry])[-MAX_ENTRIES_PER_KEY:]
+            self._save()
+
+    def _save(self) -> None:
+        recent = sorted(self._data, key=lambda master: self._data[master].get('used', 0))
+        for master in recent[:-MAX_MASTERS]:
+            del self._data[master]
+        cache.write_json(self._path, self._data)
+
+
+_stores: Dict[str, VerdictStore] = {}
+_stores_lock = threading.Lock()
+
+
+def for_repo(repo: str) -> VerdictStore:
+    with _stores_lock:
+        if repo not in _stores:
+            _stores[repo] = VerdictStore(repo)
+        return _stores[repo]
+
+
+class CachedVerdict(NamedTuple):
+    verdict: Any
+    output: str
+
+
+# Sentinel for a run that hasn't decided anything yet.
+_UNDECIDED = object()
+
+
+class RuleRun:
+    # One run of one rule against a PR.  Pass the rule .pr and .state.  If
+    # .cached is set, the verdict can be taken from it instead, with
+    # replay(); otherwise run the rule inside recording(), and report what it
+    # decided with decide().
+    def __init__(self, rule_fname: str, rule_py: Dict[str, Any], pr: pull_request.PullRequest,
+                 state: game_state.GameState):
+        self._inputs: Optional[Inputs] = None
+        self._verdict: Any = _UNDECIDED
+        self.cached: Optional[CachedVerdict] = None
+        self.pr: Any = pull_request.PullRequestView(pr)
+        self.state: Any = state
+
+        if not rule_py.get('PURE') or os.environ.get('NOMIC_NO_VERDICT_CACHE'):
+            return
+
+        self._store = for_repo(pr.commit_key()[0])
+        self._master = state.master_sha
+        self._key = '%s %s %s' % (rule_loader.rule_digest(rule_fname), pr.commit_key()[1], pr.commit_key()[2])
+
+        sources = {'pr': pr, 'state': state}
+        for entry in reversed(self._store.entries(self._master, self._key)):
+            if all(_outcome(lambda: _read(sources[source], name, args)) == outcome
+                   for source, name, args, outcome in entry['inputs']):
+                cache.count('verdicts', 'hits')
+                self.cached = CachedVerdict(entry['verdict'], entry['output'])
+                return
+
+        cache.count('verdicts', 'misses')
+        self._inputs = Inputs()
+        self.pr = RecordingPullRequestView(pr, self._inputs)
+        self.state = RecordingState(state, self._inputs)
+
+    def replay(self) -> Any:
+        assert self.cached is not None
+        print('Reusing the verdict from an earlier run with the same inputs '
+              '(NOMIC_NO_VERDICT_CACHE=1 to run it again)')
+        sys.stdout.write(self.cached.output)
+        return self.cached.verdict
+
+    def decide(self, verdict: Any) -> None:
+        self._verdict = verdict
+
+    @contextlib.contextmanager
+    def recording(self) -> Iterator[None]:
+        # Holds back what the rule prints, so it can be stored with the
+        # verdict, and then prints it.
+        if self._inputs is None:
+            yield
+            return
+
+        captured = ''
+        try:
+            with capture.captured_output() as output:
+                try:
+                    yield
+                finally:
+                    captured = output.getvalue()
+        finally:
+            sys.stdout.write(captured)
+            self._remember(self._inputs, captured)
+
+    def _remember(self, inputs: Inputs, output: str) -> None:
+        if self._verdict is _UNDECIDED:
+            return
+        if inputs.unrecordable:
+            cache.count('verdicts', 'unrecordable')
+            print('Not remembering this verdict: the rule read %s' % inputs.unrecordable)
+            return
+        self._store.add(self._master, self._key, {
+            'inputs': inputs.reads,
+            'verdict': _jsonable(self._verdict),
+            'output': output,
+        })
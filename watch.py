@@ -0,0 +1,298 @@
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import batch
+import cache
+import capture
+import game_state
+import git_mirror
+import pull_request
+import ratelimit
+import rule_loader
+import tracing
+import validate
+
+# A long-running batch.py.  Every --interval seconds, or sooner when poked, it
+# looks at master and the open PRs again and re-evaluates just the PRs where
+# something a verdict depends on has changed: the PR's commit, its reviews,
+# its age in days, the game state, or the rules and code checked out here.
+# Everything batch.py shares between PRs also carries over between polls in
+# memory: HTTP connections, the git mirror and object reader, points, and the
+# compiled rules.
+#
+# Like batch.py, PRs are evaluated by the rules and players checked out where
+# this runs, so pull to pick up changes to master.  If upstream master has
+# moved on, that's reported.
+#
+# Results go to a JSON report per PR and a summary, watch.json, in the output
+# directory, and with --port are served over HTTP on localhost:
+#
+#   GET /                  the summary
+#   GET /<pr>              the full report for one PR
+#   POST /refresh          poll now
+#   POST /refresh?all=1    poll now, and re-evaluate every PR
+#
+# Sending the process SIGUSR1 also makes it poll now.
+
+DEFAULT_INTERVAL = 60
+
+
+def checkout_digest() -> str:
+    # The rules, and the code they run, as checked out here.  Rules like pep8
+    # and typing look at the whole tree, but the top-level modules are what
+    # changes in practice; poll with ?all=1 after editing anything else.
+    digest = hashlib.sha256()
+    for _, rule_full_fname, _, _ in validate.list_rules():
+        digest.update(('%s %s\n' % (rule_full_fname, rule_loader.rule_digest(rule_full_fname))).encode('utf-8'))
+    for fname in sorted(os.listdir('.')):
+        if fname.endswith('.py'):
+            with open(fname, 'rb') as inf:
+                digest.update(('%s %s\n' % (fname, hashlib.sha256(inf.read()).hexdigest())).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def inputs_fingerprint(pr: pull_request.PullRequest, state: game_state.GameState, checkout: str) -> str:
+    # Everything about a PR, and the game around it, that its verdict could
+    # depend on.
+    return hashlib.sha256(json.dumps({
+        'commit': pr.commit_key(),
+        'author': pr.author(),
+        'reviews': sorted(pr.reviews.items()),
+        'days_since_created': pr.days_since_created(),
+        'days_since_changed': pr.days_since_changed(),
+        'master': state.master_sha,
+        'users': state.users,
+        'user_points': {user: dict(points_by_type) for user, points_by_type in state.user_points.items()},
+        'days_since_last_commit': state.days_since_last_commit,
+        'checkout': checkout,
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Watcher:
+    def __init__(self, repo: str, pr_numbers: List[str], jobs: int, output_dir: str):
+        self.repo = repo
+        self.pr_numbers = pr_numbers
+        self.jobs = jobs
+        self.output_dir = output_dir
+
+        # Set to poll before the interval is up.
+        self.wake = threading.Event()
+        self.reevaluate_all = False
+
+        # The HTTP server reads these from another thread.
+        self._lock = threading.Lock()
+        self._reports: Dict[str, Dict[str, Any]] = {}
+        self._summary: Dict[str, Any] = {'repo': repo, 'prs': []}
+
+        # pr number -> inputs_fingerprint when it was last evaluated
+        self._fingerprints: Dict[str, str] = {}
+        self._upstream_master: Optional[str] = None
+
+    def report(self, pr_number: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._reports.get(pr_number)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._summary
+
+    def _check_pr(self, pr_number: str, head: str, state: game_state.GameState,
+                  checkout: str, force: bool) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        # Returns (fingerprint, new report), with no report if nothing the
+        # verdict depends on has changed since last time.
+        pr = None
+        fingerprint = None
+        try:
+            # Loading reviews can print about old approvals.
+            with capture.captured_output():
+                pr = pull_request.PullRequest(repo=self.repo, pr_number=pr_number,
+                                              target_commit=head, users=list(state.users))
+                fingerprint = inputs_fingerprint(pr, state, checkout)
+        except Exception:
+            # evaluate() will try again, and report what went wrong.
+            pr = None
+        if not force and fingerprint is not None and fingerprint == self._fingerprints.get(pr_number):
+            return fingerprint, None
+        return fingerprint, batch.evaluate(self.repo, pr_number, head, state, pr)
+
+    def poll(self) -> None:
+        start = time.time()
+        tracing.reset()
+        force = self.reevaluate_all
+        self.reevaluate_all = False
+
+        # Fetch master and PR branches again as they're needed.
+        mirror = git_mirror.mirror(self.repo)
+        mirror.refresh()
+        upstream_master = mirror.remote_master_sha()
+
+        state = game_state.snapshot()
+        if upstream_master != state.master_sha and upstream_master != self._upstream_master:
+            print('Upstream master is at %s, but this checkout has %s; pull to evaluate against it.' % (
+                upstream_master, state.master_sha))
+        self._upstream_master = upstream_master
+
+        checkout = checkout_digest()
+        prs = batch.open_reviewme_prs(self.repo) if not self.pr_numbers else batch.head_commits(
+            self.repo, self.pr_numbers)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            results = list(executor.map(
+                lambda pr: self._check_pr(pr[0], pr[1], state, checkout, force), prs))
+
+        with self._lock:
+            reports = {pr_number: self._reports[pr_number] for pr_number, _ in prs
+                       if pr_number in self._reports}
+        fingerprints = {}
+        evaluated = []
+        for (pr_number, _), (fingerprint, report) in zip(prs, results):
+            # If it couldn't be evaluated, try again next time.
+            if fingerprint is not None and not (report and report['error']):
+                fingerprints[pr_number] = fingerprint
+            if report is not None:
+                reports[pr_number] = report
+                evaluated.append(report)
+                cache.write_json(os.path.join(self.output_dir, '%s.json' % pr_number), report)
+        self._fingerprints = fingerprints
+        pull_request.forget_shared_diffs({(self.repo, pr_number, head) for pr_number, head in prs})
+
+        summary = {
+            'repo': self.repo,
+            'updated_at': int(time.time()),
+            'master_sha': state.master_sha,
+            'upstream_master_sha': upstream_master,
+            'prs': [{key: reports[pr_number].get(key) for key in [
+                'pr', 'target_commit', 'evaluated_at', 'allowed', 'rule', 'reason', 'error', 'approvals']}
+                for pr_number, _ in prs if pr_number in reports],
+        }
+        with self._lock:
+            self._reports = reports
+            self._summary = summary
+        cache.write_json(os.path.join(self.output_dir, 'watch.json'), summary)
+
+        for report in evaluated:
+            if report['error']:
+                verdict = 'error'
+            else:
+                verdict = 'allowed' if report['allowed'] else 'blocked'
+            print('%s PR %s at %s: %s %s' % (
+                time.strftime('%H:%M:%S'), report['pr'], report['target_commit'][:8], verdict,
+                report['rule'] or report['error'] or ''))
+        print('%s polled %s PRs in %.1fs, re-evaluated %s' % (
+            time.strftime('%H:%M:%S'), len(prs), time.time() - start, len(evaluated)))
+        sys.stdout.flush()
+
+    def run(self, interval: float) -> None:
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                # Most likely the network or the API budget; try again next
+                # time.
+                traceback.print_exc()
+            self.wake.wait(interval)
+            self.wake.clear()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    watcher: Watcher
+
+    def _send_json(self, value: Any, status: int = 200) -> None:
+        body = json.dumps(value, indent=2, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        path = urllib.parse.urlparse(self.path).path.strip('/')
+        if not path:
+            self._send_json(self.watcher.summary())
+            return
+        report = self.watcher.report(path)
+        if report is None:
+            self.send_error(404, 'Not watching PR %s' % path)
+            return
+        self._send_json(report)
+
+    def do_POST(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        if url.path.strip('/') != 'refresh':
+            self.send_error(404)
+            return
+        if urllib.parse.parse_qs(url.query).get('all'):
+            self.watcher.reevaluate_all = True
+        self.watcher.wake.set()
+        self._send_json({'polling': True}, status=202)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(watcher: Watcher, port: int) -> str:
+    handler = type('Handler', (_Handler,), {'watcher': watcher})
+    server = _ThreadingServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:%s/' % server.server_address[1]
+
+
+def start():
+    parser = argparse.ArgumentParser(
+        description='Keep checking open PRs, re-evaluating each when something it depends on changes.')
+    parser.add_argument('prs', nargs='*', help='PR numbers to watch (default: every open PR labeled "reviewme")')
+    parser.add_argument('--repo', default=os.environ.get('TRAVIS_REPO_SLUG', batch.DEFAULT_REPO))
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help='seconds between polls (default %s)' % DEFAULT_INTERVAL)
+    parser.add_argument('--jobs', type=int, default=batch.DEFAULT_JOBS,
+                        help='how many PRs to check at once (default %s)' % batch.DEFAULT_JOBS)
+    parser.add_argument('--priority', choices=sorted(ratelimit.PRIORITIES), default='dashboard',
+                        help='how to share the API budget with other runs (default dashboard)')
+    parser.add_argument('--output-dir', default=None,
+                        help='where to write reports (default: the "reports" cache directory)')
+    parser.add_argument('--port', type=int, default=None,
+                        help='serve results on this port on localhost (0 picks a free one)')
+    parser.add_argument('--once', action='store_true', help='poll once and exit')
+    args = parser.parse_args()
+
+    ratelimit.set_priority(ratelimit.PRIORITIES[args.priority])
+
+    output_dir = args.output_dir or cache.cache_dir('reports')
+    os.makedirs(output_dir, exist_ok=True)
+
+    watcher = Watcher(args.repo, args.prs, args.jobs, output_dir)
+    if args.once:
+        try:
+            watcher.poll()
+        finally:
+            cache.print_stats()
+        return
+
+    # The handler runs on the main thread, which may be holding the event's
+    # lock, so it's set from another.
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=watcher.wake.set).start())
+    if args.port is not None:
+        print('Serving results at %s' % serve(watcher, args.port))
+    print('Writing results to %s' % output_dir)
+    watcher.run(args.interval)
+
+
+if __name__ == '__main__':
+    start()
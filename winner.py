@@ -0,0 +1,46 @@
+import bisect
+from typing import List, Optional, Tuple
+
+# The number line defaults to a range of 100000 points, and is only extended
+# once players have more points than that between them.  See
+# validate.determine_if_winner.
+LINE_LENGTH = 100000
+
+
+def scalar(total_points: int) -> float:
+    return min(1.0 / LINE_LENGTH, 1.0 / total_points)
+
+
+# Where each player's range on the number line ends, worked out once so that
+# finding who a random number lands on is a binary search instead of a scan.
+class WinnerTable:
+    def __init__(self, summed_user_points: List[Tuple[str, int]]):
+        self.users = [user for user, _ in summed_user_points]
+
+        # Don't include negative values when summing user points,
+        # since they have no chance to win anyway
+        total_points = sum([user_points for user, user_points
+                            in summed_user_points if user_points > 0])
+        self.scalar = scalar(total_points)
+
+        # A player wins if the random number is below the end of their range
+        # and no earlier player's.  Negative points move later ranges back
+        # down the line, so the ends aren't always increasing; keeping the
+        # highest end so far gives a sorted list where the first entry above
+        # the random number is the same player the scan would find.
+        self.thresholds: List[float] = []
+        highest = float('-inf')
+        points_so_far = 0
+        for user, user_points in summed_user_points:
+            highest = max(highest, self.scalar * (user_points + points_so_far))
+            self.thresholds.append(highest)
+            points_so_far += user_points
+
+    def chance(self, user_points: int) -> float:
+        return user_points * self.scalar
+
+    def winner(self, rnd: float) -> Optional[str]:
+        i = bisect.bisect_right(self.thresholds, rnd)
+        if i < len(self.users):
+            return self.users[i]
+        return None